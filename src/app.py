@@ -3,27 +3,62 @@ NovaSuite-AI Main Application
 Flask application with 2FA authentication, API key rotation, audit logging, and GDPR compliance
 """
 
-from flask import Flask, request, jsonify, session, render_template_string
+from flask import Flask, request, jsonify, session, render_template_string, abort, g
+from flask.json.provider import JSONProvider
+from flask.sessions import SecureCookieSessionInterface
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from sqlalchemy import select, union_all, event
+from flask_jwt_extended import (
+    JWTManager, create_access_token, get_jwt_identity, jwt_required
+)
 from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Set, Tuple, Optional, Any
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from apscheduler.schedulers.background import BackgroundScheduler
 import os
+import uuid
+import orjson
+import secrets
+import fcntl
+import time
 from functools import wraps
 import threading
 
 # Import our authentication modules
 from core.auth import (
-    TwoFactorAuth, APIKeyManager, AuditLogger, GDPRCompliance,
-    User, APIKey, AuditLog, GDPRRecord, Base
+    TwoFactorAuth, UserAuthCache, APIKeyManager, AuditLogger, GDPRCompliance,
+    User, APIKey, AuditLog, GDPRRecord
 )
+from core.auth.models import Base
+
+
+def _json_column_dumps(obj) -> str:
+    """Serializer for JSON columns (audit metadata, GDPR payloads) backed by orjson"""
+    return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
 
 # Configuration
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///novasuite.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        # JSON columns are encoded on every audit insert; orjson instead of json.dumps
+        'json_serializer': _json_column_dumps,
+        'json_deserializer': orjson.loads
+    }
+    if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS.update({
+            'pool_size': 10,
+            'max_overflow': 20
+        })
+    if SQLALCHEMY_DATABASE_URI.startswith('postgresql'):
+        SQLALCHEMY_ENGINE_OPTIONS['connect_args'] = {'options': '-c statement_timeout=5000'}
+    SLOW_QUERY_THRESHOLD_MS = int(os.environ.get('SLOW_QUERY_THRESHOLD_MS') or 100)
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'jwt-secret-change-in-production'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
     
@@ -33,6 +68,20 @@ class Config:
     SMTP_USER = os.environ.get('SMTP_USER') or 'noreply@novasuite.ai'
     SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD') or 'password'
     
+    # Background cleanup (only the worker holding the lock file runs it)
+    RUN_CLEANUP = os.environ.get('RUN_CLEANUP', '1') == '1'
+    CLEANUP_LOCK_FILE = os.environ.get('CLEANUP_LOCK_FILE') or '/tmp/novasuite-cleanup.lock'
+    
+    # Audit rows are queued and inserted by a background writer in batches
+    AUDIT_LOG_BUFFER_SIZE = int(os.environ.get('AUDIT_LOG_BUFFER_SIZE') or 256)
+    AUDIT_LOG_FLUSH_INTERVAL = float(os.environ.get('AUDIT_LOG_FLUSH_INTERVAL') or 0.05)
+    
+    # 2FA state cache and email verification tokens; in-process unless a Redis URL is configured
+    REDIS_URL = os.environ.get('REDIS_URL')
+    TWO_FACTOR_CACHE_TTL = int(os.environ.get('TWO_FACTOR_CACHE_TTL') or 300)
+    # Parallel audit writers, sharded by user_id (always one on SQLite)
+    AUDIT_LOG_WRITER_SHARDS = int(os.environ.get('AUDIT_LOG_WRITER_SHARDS') or os.cpu_count() or 1)
+    
     # GDPR Data Controller Information
     DATA_CONTROLLER = {
         'name': 'NovaSuite-AI',
@@ -41,22 +90,123 @@ class Config:
         'dpo_email': 'dpo@novasuite.ai'
     }
 
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson for request parsing and responses"""
+    
+    option = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self._default, option=self.option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self._default, option=self.option),
+            mimetype='application/json'
+        )
+    
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, (Decimal, uuid.UUID)):
+            return str(obj)
+        if isinstance(obj, Mapping):
+            # SQLAlchemy row mappings returned straight from Core selects
+            return dict(obj)
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class StatelessAPISessionInterface(SecureCookieSessionInterface):
+    """Skip signed-cookie session loading for API key and bearer token requests"""
+    
+    def open_session(self, app, request):
+        if 'X-API-Key' in request.headers or request.headers.get('Authorization', '').startswith('Bearer '):
+            # Stateless request: never verify or deserialize the cookie
+            return self.session_class()
+        return super().open_session(app, request)
+
+# JWT verification cache
+class JwtCache:
+    """LRU cache of signature-verified JWT claims keyed by the encoded token"""
+    
+    def __init__(self, maxsize: int = 8192):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        """Get cached claims, evicting the entry if the token is no longer valid"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            
+            claims, exp = entry
+            now = time.time()
+            if (exp is not None and now >= exp) or now < claims.get('nbf', 0):
+                del self._entries[token]
+                return None
+            
+            self._entries.move_to_end(token)
+            return claims
+    
+    def put(self, token: str, claims: Dict[str, Any]):
+        """Cache verified claims for a token"""
+        with self._lock:
+            self._entries[token] = (claims, claims.get('exp'))
+            self._entries.move_to_end(token)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+jwt_cache = JwtCache()
+
+class CachingJWTManager(JWTManager):
+    """
+    JWTManager that caches only the signature check and claim decoding of tokens;
+    type, blocklist and user-lookup checks still run on every request
+    """
+    
+    # Overrides a private flask_jwt_extended 4.7 method: requirements.txt pins <4.8 and
+    # tests/test_app.py fails if the upstream signature changes
+    def _decode_jwt_from_config(self, encoded_token: str, csrf_value=None, allow_expired: bool = False) -> dict:
+        cacheable = csrf_value is None and not allow_expired
+        claims = jwt_cache.get(encoded_token) if cacheable else None
+        if claims is None:
+            claims = super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+            if cacheable:
+                jwt_cache.put(encoded_token, claims)
+        # Callers get their own copy so the cached claims cannot be modified
+        return dict(claims)
+
 # Initialize Flask app
 app = Flask(__name__)
 app.config.from_object(Config)
+app.json = OrjsonProvider(app)
+app.session_interface = StatelessAPISessionInterface()
 
 # Initialize extensions
 db = SQLAlchemy(app)
-jwt = JWTManager(app)
-limiter = Limiter(
-    app,
-    key_func=get_remote_address,
-    default_limits=["1000 per hour"]
-)
+jwt = CachingJWTManager(app)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Relax SQLite fsyncs: WAL journal, NORMAL sync and fewer checkpoints"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA wal_autocheckpoint=10000')
+    cursor.close()
 
-# Create database tables
+# Create database tables only when explicitly requested (see initdb.py)
 with app.app_context():
-    Base.metadata.create_all(db.engine)
+    db_engine = db.engine
+    # Deliberately app-wide on SQLite: every transaction (users, API keys, GDPR, audit) runs
+    # in WAL mode with NORMAL sync, so a power loss can drop the last commits but never
+    # corrupts the file. Registered before the first connection is opened.
+    if db_engine.dialect.name == 'sqlite':
+        event.listen(db_engine, 'connect', _set_sqlite_pragmas)
+    if os.environ.get('INIT_DB') == '1':
+        Base.metadata.create_all(db_engine)
 
 # Initialize our authentication services
 email_config = {
@@ -66,22 +216,195 @@ email_config = {
     'smtp_password': app.config['SMTP_PASSWORD']
 }
 
-audit_logger = AuditLogger(db.session)
-two_factor_auth = TwoFactorAuth(db.session, email_config, audit_logger)
-api_key_manager = APIKeyManager(db.session, audit_logger)
+audit_logger = AuditLogger(
+    db.session, batch_writes=True, engine=db_engine,
+    flush_interval=app.config['AUDIT_LOG_FLUSH_INTERVAL'],
+    batch_size=app.config['AUDIT_LOG_BUFFER_SIZE'],
+    writer_shards=app.config['AUDIT_LOG_WRITER_SHARDS']
+)
+api_key_manager = APIKeyManager(
+    db.session, audit_logger, encryption_key=os.environ.get('API_KEY_ENCRYPTION_KEY') or None,
+    engine=db_engine
+)
+redis_client = None
+auth_cache = None
+if app.config['REDIS_URL']:
+    import base64
+    import redis
+    from cryptography.fernet import Fernet
+    redis_client = redis.Redis.from_url(app.config['REDIS_URL'])
+    # TOTP secrets are stored in Redis encrypted with their own subkey of the encryption key
+    auth_cache = UserAuthCache(
+        redis_client,
+        ttl=app.config['TWO_FACTOR_CACHE_TTL'],
+        cipher=Fernet(base64.urlsafe_b64encode(api_key_manager.derive_key("2fa-state-cache")))
+    )
+two_factor_auth = TwoFactorAuth(
+    db.session, email_config, audit_logger, auth_cache=auth_cache, redis_client=redis_client
+)
 gdpr_compliance = GDPRCompliance(
     db.session, 
     audit_logger, 
     email_config, 
     app.config['DATA_CONTROLLER']
 )
+# Erasure bypasses the managers, so they drop their cached state for erased users
+gdpr_compliance.on_users_erased(api_key_manager.invalidate_users)
+gdpr_compliance.on_users_erased(two_factor_auth.invalidate_users)
+
+# Slow query logging
+@event.listens_for(db_engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+@event.listens_for(db_engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - conn.info['query_start_time'].pop()) * 1000
+    # Audit writes are not reported: the report is itself an audit write on this engine
+    if duration_ms > app.config['SLOW_QUERY_THRESHOLD_MS'] and 'audit_logs' not in statement:
+        audit_logger.log_event(
+            event_type='slow_query',
+            event_category='system',
+            action='execute_query',
+            success=True,
+            metadata={
+                'duration_ms': round(duration_ms, 2),
+                'statement': statement[:500],
+                'executemany': executemany
+            }
+        )
+
+# In-process rate limiting
+def get_remote_address():
+    """Get the client IP address for the current request"""
+    return request.remote_addr or '127.0.0.1'
+
+def client_ip():
+    """Get the client IP address, resolved once per request"""
+    ip = g.get('client_ip')
+    if ip is None:
+        ip = g.client_ip = get_remote_address()
+    return ip
+
+class TokenBucket:
+    """Token bucket state for a single rate-limit key"""
+    __slots__ = ('tokens', 'ts')
+    
+    def __init__(self, tokens: float, ts: float):
+        self.tokens = tokens
+        self.ts = ts
+
+RATE_FLUSH_INTERVAL = 0.02  # seconds
+RATE_BUCKET_PRUNE_INTERVAL = 60.0  # seconds
 
-# Start automatic API key rotation
-api_key_manager.start_automatic_rotation()
+_LIMITS: Dict[str, Tuple[int, float]] = {}  # scope -> (capacity, refill per second)
+_BUCKETS: Dict[Tuple[str, str], TokenBucket] = {}
+_blocked: Set[Tuple[str, str]] = set()
+# Keys of counted requests waiting for the flusher; deque append/popleft are thread-safe
+_pending_hits = deque()
+_last_bucket_prune = 0.0
+
+def register_rate_limit(scope: str, cap: int, per: int):
+    """Register the limit of `cap` requests per `per` seconds for a scope"""
+    _LIMITS[scope] = (cap, cap / per)
+
+def check_rate(scope: str, client: str) -> bool:
+    """
+    Count a request for (scope, client) and return False if the client is blocked.
+    Only appends to the pending queue; accounting happens in the background flusher.
+    """
+    key = (scope, client)
+    if key in _blocked:
+        return False
+    
+    _pending_hits.append(key)
+    return True
+
+def _drain_pending_hits() -> Dict[Tuple[str, str], int]:
+    """Pop every queued request key and count them per key"""
+    drained = {}
+    popleft = _pending_hits.popleft
+    try:
+        while True:
+            key = popleft()
+            drained[key] = drained.get(key, 0) + 1
+    except IndexError:
+        pass
+    return drained
+
+def _prune_buckets(now: float):
+    """Forget buckets that have refilled to capacity and are not blocked"""
+    for key, b in list(_BUCKETS.items()):
+        cap, refill_per_sec = _LIMITS[key[0]]
+        if key not in _blocked and b.tokens + (now - b.ts) * refill_per_sec >= cap:
+            del _BUCKETS[key]
+
+def flush_rate_counters():
+    """Drain pending request counts into the token buckets and update the blocked set"""
+    global _last_bucket_prune
+    now = time.monotonic()
+    drained = _drain_pending_hits()
+    
+    # Blocked keys are revisited so they get unblocked once their bucket refills
+    for key in drained.keys() | _blocked:
+        cap, refill_per_sec = _LIMITS[key[0]]
+        b = _BUCKETS.get(key)
+        if b is None:
+            b = _BUCKETS[key] = TokenBucket(cap, now)
+        
+        b.tokens = min(cap, b.tokens + (now - b.ts) * refill_per_sec)
+        b.tokens = max(0, b.tokens - drained.get(key, 0))
+        b.ts = now
+        
+        if b.tokens < 1:
+            _blocked.add(key)
+        else:
+            _blocked.discard(key)
+    
+    if now - _last_bucket_prune >= RATE_BUCKET_PRUNE_INTERVAL:
+        _last_bucket_prune = now
+        _prune_buckets(now)
+
+def _rate_flush_worker():
+    """Background worker flushing rate-limit counters"""
+    while not rate_flush_stop.wait(RATE_FLUSH_INTERVAL):
+        try:
+            flush_rate_counters()
+        except Exception:
+            app.logger.exception("Rate limit counter flush failed")
+
+def ratelimit(cap: int, per: int):
+    """Decorator to limit a route to `cap` requests per `per` seconds per client"""
+    def decorator(f):
+        register_rate_limit(f.__name__, cap, per)
+        
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not check_rate(f.__name__, client_ip()):
+                abort(429)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+register_rate_limit('default', 1000, 3600)
+
+@app.before_request
+def default_ratelimit():
+    """Apply the global limit of 1000 requests per hour per client"""
+    if not check_rate('default', client_ip()):
+        abort(429)
+
+rate_flush_stop = threading.Event()
+rate_flush_thread = threading.Thread(target=_rate_flush_worker, daemon=True)
+rate_flush_thread.start()
 
 # Helper decorators
 def api_key_required(scopes=None):
     """Decorator to require valid API key"""
+    # Everything a request needs is resolved once per route at import time
+    required_scopes = frozenset(scopes or ())
+    verify = api_key_manager.verify_api_key
+    
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
@@ -89,13 +412,7 @@ def api_key_required(scopes=None):
             if not api_key:
                 return jsonify({'error': 'API key required'}), 401
             
-            client_ip = get_remote_address()
-            verified_key = api_key_manager.verify_api_key(
-                api_key, 
-                required_scopes=scopes,
-                client_ip=client_ip
-            )
-            
+            verified_key = verify(api_key, required_scopes, client_ip())
             if not verified_key:
                 return jsonify({'error': 'Invalid API key'}), 401
             
@@ -104,17 +421,25 @@ def api_key_required(scopes=None):
         return decorated_function
     return decorator
 
+def find_user(username, email):
+    """Find a user by username or email, probing each unique index separately"""
+    stmt = union_all(
+        select(User).where(User.username == username),
+        select(User).where(User.email == email)
+    ).limit(1)
+    return db.session.execute(select(User).from_statement(stmt)).scalar()
+
 def get_request_info():
     """Get request information for logging"""
     return {
-        'ip_address': get_remote_address(),
+        'ip_address': client_ip(),
         'user_agent': request.headers.get('User-Agent'),
         'session_id': session.get('session_id')
     }
 
 # Authentication Routes
 @app.route('/api/auth/register', methods=['POST'])
-@limiter.limit("5 per minute")
+@ratelimit(cap=5, per=60)
 def register():
     """User registration with GDPR consent"""
     try:
@@ -131,9 +456,7 @@ def register():
             return jsonify({'error': 'GDPR consent required'}), 400
         
         # Check if user exists
-        if db.session.query(User).filter(
-            (User.username == username) | (User.email == email)
-        ).first():
+        if find_user(username, email):
             return jsonify({'error': 'User already exists'}), 409
         
         # Create user
@@ -178,7 +501,7 @@ def register():
         return jsonify({'error': 'Registration failed'}), 500
 
 @app.route('/api/auth/login', methods=['POST'])
-@limiter.limit("10 per minute")
+@ratelimit(cap=10, per=60)
 def login():
     """User login with optional 2FA"""
     try:
@@ -194,9 +517,7 @@ def login():
             return jsonify({'error': 'Username and password required'}), 400
         
         # Find user
-        user = db.session.query(User).filter(
-            (User.username == username) | (User.email == username)
-        ).first()
+        user = find_user(username, username)
         
         if not user or not user.check_password(password):
             if user:
@@ -257,7 +578,7 @@ def login():
             additional_claims={'username': user.username}
         )
         
-        session['session_id'] = f"sess_{user.id}_{datetime.utcnow().timestamp()}"
+        session['session_id'] = f"sess_{user.id}_{secrets.token_urlsafe(12)}"
         
         audit_logger.log_authentication_event(
             user_id=user.id,
@@ -291,13 +612,18 @@ def setup_2fa():
     try:
         user_id = get_jwt_identity()
         
-        secret, qr_code, backup_codes = two_factor_auth.enable_2fa_totp(user_id)
+        render_qr = request.args.get('qr', 'true').lower() == 'true'
+        
+        secret, provisioning, backup_codes = two_factor_auth.enable_2fa_totp(user_id, qr=render_qr)
         
         return jsonify({
             'secret': secret,
-            'qr_code': qr_code,
+            'qr_code' if render_qr else 'otpauth_uri': provisioning,
             'backup_codes': backup_codes,
-            'message': 'Scan QR code with authenticator app and verify with a token'
+            'message': (
+                'Scan QR code with authenticator app and verify with a token' if render_qr
+                else 'Add the otpauth URI to an authenticator app and verify with a token'
+            )
         }), 200
         
     except Exception as e:
@@ -548,8 +874,15 @@ def search_audit_logs():
         
         limit = int(request.args.get('limit', 100))
         offset = int(request.args.get('offset', 0))
-        
-        results = audit_logger.search_audit_logs(filters, limit, offset)
+        include_total = request.args.get('include_total') == '1'
+        after_timestamp = request.args.get('after_timestamp')
+        after_id = request.args.get('after_id')
+        
+        results = audit_logger.search_audit_logs(
+            filters, limit, offset, include_total=include_total,
+            after_timestamp=datetime.fromisoformat(after_timestamp) if after_timestamp else None,
+            after_id=int(after_id) if after_id else None
+        )
         
         return jsonify(results), 200
         
@@ -627,17 +960,20 @@ def gdpr_dashboard():
         return jsonify({'error': str(e)}), 500
 
 # Health check
+HEALTH_SERVICES = {
+    'database': 'up',
+    'audit_logging': 'up',
+    'api_key_rotation': 'up'
+}
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'timestamp': datetime.utcnow().isoformat(),
-        'services': {
-            'database': 'up',
-            'audit_logging': 'up',
-            'api_key_rotation': 'up'
-        }
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+        'services': HEALTH_SERVICES,
+        'audit_dropped_events': audit_logger.dropped_events
     }), 200
 
 # Error handlers
@@ -647,7 +983,7 @@ def ratelimit_handler(e):
         event_type='rate_limit_exceeded',
         description='Rate limit exceeded',
         severity='medium',
-        ip_address=get_remote_address()
+        ip_address=client_ip()
     )
     return jsonify({'error': 'Rate limit exceeded'}), 429
 
@@ -685,10 +1021,40 @@ def cleanup_task():
                 error_message=str(e)
             )
 
-# Schedule cleanup task to run daily
-cleanup_thread = threading.Timer(86400, cleanup_task)  # 24 hours
-cleanup_thread.daemon = True
-cleanup_thread.start()
+def rotation_task():
+    """Background task for automatic API key rotation"""
+    with app.app_context():
+        api_key_manager.run_scheduled_rotation()
+
+def backfill_task():
+    """One-shot background task computing lookup HMACs for keys stored before the index"""
+    with app.app_context():
+        try:
+            api_key_manager.backfill_lookup_hmacs()
+        except Exception:
+            # Already audited by the manager; a missing schema must not take the worker down
+            app.logger.exception("API key lookup backfill failed")
+
+def acquire_cleanup_lock():
+    """Try to become the single worker that runs cleanup, returns the held lock file or None"""
+    lock_file = open(app.config['CLEANUP_LOCK_FILE'], 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+# Schedule cleanup and API key rotation to run daily, in one worker process only
+scheduler = BackgroundScheduler(daemon=True)
+cleanup_lock = acquire_cleanup_lock() if app.config['RUN_CLEANUP'] else None
+if cleanup_lock:
+    # Runs once, right after start, off the import path
+    scheduler.add_job(backfill_task, 'date', run_date=datetime.now(), id='backfill_task',
+                      misfire_grace_time=None)
+    scheduler.add_job(cleanup_task, 'interval', hours=24, id='cleanup_task')
+    api_key_manager.start_automatic_rotation(scheduler, job=rotation_task)
+scheduler.start()
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
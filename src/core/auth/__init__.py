@@ -3,7 +3,7 @@ NovaSuite-AI Authentication Module
 Provides 2FA, JWT tokens, API key rotation, and GDPR compliance
 """
 
-from .two_factor_auth import TwoFactorAuth
+from .two_factor_auth import TwoFactorAuth, UserAuthCache
 from .api_key_manager import APIKeyManager
 from .audit_logger import AuditLogger
 from .gdpr_compliance import GDPRCompliance
@@ -11,6 +11,7 @@ from .models import User, APIKey, AuditLog, GDPRRecord
 
 __all__ = [
     'TwoFactorAuth',
+    'UserAuthCache',
     'APIKeyManager', 
     'AuditLogger',
     'GDPRCompliance',
@@ -6,28 +6,185 @@ Handles API key lifecycle, rotation every 30 days, and security monitoring
 import uuid
 import secrets
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional, Tuple
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Callable
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.engine import Engine
+from sqlalchemy import inspect
+from sqlalchemy import and_, or_, select, update, func, case, bindparam
 import threading
 import time
-from cryptography.fernet import Fernet
+import atexit
 import base64
+import os
+import hashlib
+import ipaddress
+import hmac
+from collections import OrderedDict, Counter, defaultdict
+from itertools import chain
+from functools import cached_property
 
 from .models import User, APIKey, AuditLog
 from .audit_logger import AuditLogger
 
 
+ROTATION_JOB_ID = 'api_key_rotation'
+
+# Marks key_hash values written as AES-GCM; anything else is a legacy Fernet token
+AESGCM_PREFIX = 'gcm1:'
+# Every Fernet token starts with the base64 of its 0x80 version byte and timestamp high bytes
+FERNET_PREFIX = 'gAAAAA'
+
+# Hot-path statements built once at import; per call only the bound parameters change
+_ACTIVE_AT_NOW = and_(
+    APIKey.is_active == True,
+    or_(APIKey.expires_at.is_(None), APIKey.expires_at > bindparam('now'))
+)
+
+_VERIFY_STMT = select(*APIKey.__table__.c).where(
+    APIKey.key_lookup_hmac == bindparam('lookup_hmac'), _ACTIVE_AT_NOW
+)
+
+_LEGACY_KEYS_STMT = select(APIKey).where(APIKey.key_lookup_hmac.is_(None))
+
+_LIST_COLUMNS_STMT = select(
+    APIKey.id, APIKey.name, APIKey.scopes, APIKey.created_at,
+    APIKey.expires_at, APIKey.last_used, APIKey.usage_count,
+    APIKey.is_active, APIKey.rate_limit, APIKey.ip_whitelist
+).where(APIKey.user_id == bindparam('user_id'))
+
+_LIST_ACTIVE_STMT = _LIST_COLUMNS_STMT.where(APIKey.is_active == True)
+
+_EXPIRING_BATCH_STMT = select(
+    APIKey.id, APIKey.user_id, APIKey.name, APIKey.key_hash, APIKey.expires_at
+).where(
+    APIKey.is_active == True,
+    APIKey.expires_at <= bindparam('expiring_date'),
+    APIKey.expires_at > bindparam('now'),
+    APIKey.id > bindparam('last_id')
+).order_by(APIKey.id).limit(bindparam('batch_size')).with_for_update(skip_locked=True)
+
+
+# Table-level (Core) executemany; last_used only moves forward, whichever worker's flush lands last
+_api_keys = APIKey.__table__
+_USAGE_UPDATE_STMT = update(_api_keys).where(_api_keys.c.id == bindparam('api_key_id')).values(
+    usage_count=func.coalesce(_api_keys.c.usage_count, 0) + bindparam('uses'),
+    last_used=case(
+        (or_(_api_keys.c.last_used.is_(None), _api_keys.c.last_used < bindparam('used_at')),
+         bindparam('used_at')),
+        else_=_api_keys.c.last_used
+    )
+)
+
+
+class _VerificationCache:
+    """Thread-safe TTL LRU mapping presented-token hashes to verified API key entries"""
+    
+    def __init__(self, maxsize: int = 4096, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_id = {}
+        self._lock = threading.Lock()
+    
+    def get(self, token_hash: bytes) -> Optional[Tuple]:
+        with self._lock:
+            item = self._entries.get(token_hash)
+            if item is None:
+                return None
+            entry, stored_at = item
+            if time.monotonic() - stored_at > self.ttl:
+                # Bounds how long a change made by another process can go unseen
+                del self._entries[token_hash]
+                if self._keys_by_id.get(entry[0]) == token_hash:
+                    del self._keys_by_id[entry[0]]
+                return None
+            self._entries.move_to_end(token_hash)
+            return entry
+    
+    def put(self, token_hash: bytes, entry: Tuple):
+        """Store an entry; entry[0] must be the API key id"""
+        with self._lock:
+            self._entries[token_hash] = (entry, time.monotonic())
+            self._entries.move_to_end(token_hash)
+            self._keys_by_id[entry[0]] = token_hash
+            if len(self._entries) > self.maxsize:
+                evicted_hash, (evicted, _) = self._entries.popitem(last=False)
+                if self._keys_by_id.get(evicted[0]) == evicted_hash:
+                    del self._keys_by_id[evicted[0]]
+    
+    def discard(self, token_hash: bytes):
+        with self._lock:
+            item = self._entries.pop(token_hash, None)
+            if item is not None:
+                self._keys_by_id.pop(item[0][0], None)
+    
+    def discard_api_key(self, api_key_id: int):
+        with self._lock:
+            token_hash = self._keys_by_id.pop(api_key_id, None)
+            if token_hash is not None:
+                self._entries.pop(token_hash, None)
+    
+    def discard_users(self, user_ids: Iterable[int]):
+        """Drop every entry whose key belongs to one of the given users"""
+        user_ids = frozenset(user_ids)
+        with self._lock:
+            stale = [token_hash for token_hash, ((_, snapshot), _) in self._entries.items()
+                     if snapshot.user_id in user_ids]
+            for token_hash in stale:
+                (api_key_id, _), _ = self._entries.pop(token_hash)
+                if self._keys_by_id.get(api_key_id) == token_hash:
+                    del self._keys_by_id[api_key_id]
+
+
 class APIKeyManager:
     """API Key management with automatic rotation"""
     
-    def __init__(self, db_session: Session, audit_logger: AuditLogger, encryption_key: str = None):
+    def __init__(self, db_session: Session, audit_logger: AuditLogger, encryption_key: str = None,
+                 engine: Optional[Engine] = None, usage_flush_interval: float = 5.0):
         self.db = db_session
         self.audit_logger = audit_logger
-        self.encryption_key = encryption_key or Fernet.generate_key()
-        self.cipher_suite = Fernet(self.encryption_key)
-        self._rotation_thread = None
-        self._stop_rotation = False
+        # Same format as Fernet.generate_key(): 32 random bytes, url-safe base64
+        self.encryption_key = encryption_key or base64.urlsafe_b64encode(os.urandom(32))
+        self._rotation_scheduler = None
+        self._verification_cache = _VerificationCache(maxsize=10_000, ttl=60)
+        self.rotation_batch_size = 500
+        
+        # Usage counters aggregated in memory, written by one bulk UPDATE per flush;
+        # without an engine the session's bind is used
+        self._usage_counters = {}
+        self._usage_lock = threading.Lock()
+        self._usage_engine = engine
+        self._usage_stop = threading.Event()
+        self._usage_thread = threading.Thread(
+            target=self._usage_flush_worker, args=(usage_flush_interval,), daemon=True
+        )
+        self._usage_thread.start()
+        atexit.register(self.close)
+    
+    def derive_key(self, purpose: str) -> bytes:
+        """Derive an independent 32-byte subkey of the encryption key for one purpose (HKDF-SHA256)"""
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=f"novasuite:{purpose}".encode())
+        return hkdf.derive(base64.urlsafe_b64decode(self.encryption_key))
+    
+    @cached_property
+    def cipher_suite(self):
+        """Fernet cipher for legacy stored keys (read-only); cryptography is only imported when first needed"""
+        from cryptography.fernet import Fernet
+        return Fernet(self.encryption_key)
+    
+    @cached_property
+    def _aesgcm(self):
+        """AES-256-GCM cipher for stored keys"""
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        return AESGCM(self.derive_key("api-key-aes-gcm"))
+    
+    @cached_property
+    def hmac_key(self) -> bytes:
+        """Key of the deterministic lookup HMAC"""
+        return self.derive_key("api-key-lookup-hmac")
     
     def create_api_key(self, user_id: int, name: str, scopes: List[str] = None, 
                       expires_days: int = 30, rate_limit: int = 1000,
@@ -48,14 +205,17 @@ class APIKeyManager:
             api_key = APIKey(
                 user_id=user_id,
                 name=name,
-                scopes=scopes or [],
+                scopes=list(dict.fromkeys(scopes or [])),  # Deduplicated, order kept
                 expires_days=expires_days
             )
             api_key.rate_limit = rate_limit
             api_key.ip_whitelist = ip_whitelist or []
+            for entry in api_key.ip_whitelist:
+                ipaddress.ip_network(entry, strict=False)  # Single addresses or CIDR ranges
             
             # Store encrypted key hash
             api_key.key_hash = self._encrypt_key(api_key_string)
+            api_key.key_lookup_hmac = self._lookup_hmac(api_key_string)
             
             self.db.add(api_key)
             self.db.commit()
@@ -99,34 +259,12 @@ class APIKeyManager:
                 raise ValueError("API key not found")
             
             old_key_hash = api_key.key_hash
-            
-            # Generate new key
-            new_api_key_string = self._generate_secure_key()
-            api_key.key_hash = self._encrypt_key(new_api_key_string)
-            
-            # Extend expiration if requested
-            if extend_expiration:
-                api_key.expires_at = datetime.utcnow() + timedelta(days=30)
-            
-            # Reset usage statistics
-            api_key.usage_count = 0
-            api_key.last_used = None
+            new_api_key_string = self._rotate_api_key_nocommit(api_key, extend_expiration)
             
             self.db.commit()
             
-            self.audit_logger.log_event(
-                event_type="api_key_rotated",
-                event_category="api",
-                action="rotate_api_key",
-                user_id=api_key.user_id,
-                success=True,
-                metadata={
-                    "api_key_id": api_key_id,
-                    "name": api_key.name,
-                    "old_key_hash": old_key_hash[:10] + "...",  # Log only partial hash
-                    "new_expires_at": api_key.expires_at.isoformat() if api_key.expires_at else None
-                }
-            )
+            self._log_rotation(api_key_id, api_key.user_id, api_key.name, old_key_hash,
+                               api_key.expires_at.isoformat() if api_key.expires_at else None)
             
             return new_api_key_string, api_key
             
@@ -141,36 +279,24 @@ class APIKeyManager:
             )
             raise
     
-    def verify_api_key(self, api_key_string: str, required_scopes: List[str] = None,
+    def verify_api_key(self, api_key_string: str, required_scopes: Iterable[str] = None,
                       client_ip: str = None) -> Optional[APIKey]:
         """
         Verify API key and check permissions
         Returns API key object if valid, None otherwise
         """
         try:
-            # Try to find matching key by checking all active keys
-            active_keys = self.db.query(APIKey).filter(
-                and_(
-                    APIKey.is_active == True,
-                    or_(
-                        APIKey.expires_at.is_(None),
-                        APIKey.expires_at > datetime.utcnow()
-                    )
-                )
-            ).all()
+            lookup_hmac = self._lookup_hmac(api_key_string)
             
-            api_key = None
-            for key in active_keys:
-                try:
-                    decrypted_key = self._decrypt_key(key.key_hash)
-                    if secrets.compare_digest(decrypted_key, api_key_string):
-                        api_key = key
-                        break
-                except:
-                    continue  # Invalid encrypted key, skip
+            # Checks run against a detached snapshot; the session is only touched to record usage
+            api_key = self._get_cached_api_key(lookup_hmac)
+            if api_key is None:
+                api_key = self._find_api_key(lookup_hmac)
+                if api_key:
+                    self._verification_cache.put(lookup_hmac, (api_key.id, api_key))
             
             if not api_key:
-                self.audit_logger.log_event(
+                self.audit_logger.log_event_async(
                     event_type="api_key_verification_failed",
                     event_category="api",
                     action="verify_api_key",
@@ -182,7 +308,7 @@ class APIKeyManager:
             
             # Check if key is still valid
             if not api_key.is_valid():
-                self.audit_logger.log_event(
+                self.audit_logger.log_event_async(
                     event_type="api_key_expired",
                     event_category="api",
                     action="verify_api_key",
@@ -195,8 +321,8 @@ class APIKeyManager:
             
             # Check IP whitelist
             if api_key.ip_whitelist and client_ip:
-                if client_ip not in api_key.ip_whitelist:
-                    self.audit_logger.log_event(
+                if not self._ip_allowed(client_ip, api_key.ip_networks):
+                    self.audit_logger.log_event_async(
                         event_type="api_key_ip_blocked",
                         event_category="security",
                         action="verify_api_key",
@@ -209,8 +335,10 @@ class APIKeyManager:
             
             # Check required scopes
             if required_scopes:
-                if not all(scope in api_key.scopes for scope in required_scopes):
-                    self.audit_logger.log_event(
+                if not isinstance(required_scopes, frozenset):
+                    required_scopes = frozenset(required_scopes)
+                if not required_scopes.issubset(api_key.scope_set):
+                    self.audit_logger.log_event_async(
                         event_type="api_key_insufficient_scope",
                         event_category="security",
                         action="verify_api_key",
@@ -219,17 +347,16 @@ class APIKeyManager:
                         error_message="Insufficient API key scope",
                         metadata={
                             "api_key_id": api_key.id,
-                            "required_scopes": required_scopes,
+                            "required_scopes": sorted(required_scopes),
                             "available_scopes": api_key.scopes
                         }
                     )
                     return None
             
-            # Record successful usage
-            api_key.record_usage()
-            self.db.commit()
+            # Record successful usage in memory; flushed to the database in bulk
+            pending_uses = self._record_usage(api_key.id)
             
-            self.audit_logger.log_event(
+            self.audit_logger.log_event_async(
                 event_type="api_key_used",
                 event_category="api",
                 action="verify_api_key",
@@ -237,7 +364,7 @@ class APIKeyManager:
                 success=True,
                 metadata={
                     "api_key_id": api_key.id,
-                    "usage_count": api_key.usage_count,
+                    "usage_count": (api_key.usage_count or 0) + pending_uses,
                     "client_ip": client_ip
                 }
             )
@@ -245,7 +372,7 @@ class APIKeyManager:
             return api_key
             
         except Exception as e:
-            self.audit_logger.log_event(
+            self.audit_logger.log_event_async(
                 event_type="api_key_verification_error",
                 event_category="api",
                 action="verify_api_key",
@@ -264,6 +391,7 @@ class APIKeyManager:
             
             api_key.is_active = False
             self.db.commit()
+            self._verification_cache.discard_api_key(api_key_id)
             
             self.audit_logger.log_event(
                 event_type="api_key_revoked",
@@ -294,15 +422,12 @@ class APIKeyManager:
     def list_user_api_keys(self, user_id: int, include_inactive: bool = False) -> List[Dict[str, Any]]:
         """List API keys for user"""
         try:
-            query = self.db.query(APIKey).filter(APIKey.user_id == user_id)
-            
-            if not include_inactive:
-                query = query.filter(APIKey.is_active == True)
-            
-            api_keys = query.all()
+            # Plain column rows: no ORM hydration and no relationship to lazy-load
+            stmt = _LIST_COLUMNS_STMT if include_inactive else _LIST_ACTIVE_STMT
             
+            now = datetime.utcnow()
             result = []
-            for key in api_keys:
+            for key in self.db.execute(stmt, {'user_id': user_id}):
                 result.append({
                     'id': key.id,
                     'name': key.name,
@@ -312,7 +437,7 @@ class APIKeyManager:
                     'last_used': key.last_used.isoformat() if key.last_used else None,
                     'usage_count': key.usage_count,
                     'is_active': key.is_active,
-                    'is_expired': key.is_expired(),
+                    'is_expired': bool(key.expires_at and key.expires_at < now),
                     'rate_limit': key.rate_limit,
                     'ip_whitelist': key.ip_whitelist
                 })
@@ -330,18 +455,14 @@ class APIKeyManager:
             )
             raise
     
-    def start_automatic_rotation(self, check_interval_hours: int = 24):
-        """Start automatic API key rotation background process"""
-        if self._rotation_thread and self._rotation_thread.is_alive():
-            return  # Already running
-        
-        self._stop_rotation = False
-        self._rotation_thread = threading.Thread(
-            target=self._rotation_worker,
-            args=(check_interval_hours,),
-            daemon=True
+    def start_automatic_rotation(self, scheduler, check_interval_hours: int = 24,
+                                 job: Callable[[], None] = None):
+        """Schedule automatic API key rotation on an APScheduler scheduler"""
+        self._rotation_scheduler = scheduler
+        scheduler.add_job(
+            job or self.run_scheduled_rotation, 'interval',
+            hours=check_interval_hours, id=ROTATION_JOB_ID, replace_existing=True
         )
-        self._rotation_thread.start()
         
         self.audit_logger.log_event(
             event_type="auto_rotation_started",
@@ -353,9 +474,9 @@ class APIKeyManager:
     
     def stop_automatic_rotation(self):
         """Stop automatic API key rotation"""
-        self._stop_rotation = True
-        if self._rotation_thread:
-            self._rotation_thread.join(timeout=5)
+        if self._rotation_scheduler and self._rotation_scheduler.get_job(ROTATION_JOB_ID):
+            self._rotation_scheduler.remove_job(ROTATION_JOB_ID)
+        self._rotation_scheduler = None
         
         self.audit_logger.log_event(
             event_type="auto_rotation_stopped",
@@ -364,6 +485,79 @@ class APIKeyManager:
             success=True
         )
     
+    def run_scheduled_rotation(self):
+        """Rotate keys expiring in the next 7 days and notify their owners"""
+        try:
+            rotated = self.rotate_expiring_keys(days_before_expiry=7)
+            
+            if rotated:
+                # In production, notify users about rotated keys
+                self._notify_users_about_rotation(rotated)
+                
+        except Exception as e:
+            self.audit_logger.log_event(
+                event_type="rotation_worker_error",
+                event_category="api",
+                action="automatic_rotation",
+                success=False,
+                error_message=str(e)
+            )
+    
+    def backfill_lookup_hmacs(self) -> int:
+        """
+        Compute key_lookup_hmac for keys stored before the lookup index existed
+        Returns number of keys backfilled
+        """
+        from cryptography.exceptions import InvalidTag
+        from cryptography.fernet import InvalidToken
+        
+        try:
+            backfilled = 0
+            for api_key in self.db.execute(_LEGACY_KEYS_STMT).scalars():
+                # Cheap shape check first: malformed values are skipped without raising
+                if not (api_key.key_hash or '').startswith((AESGCM_PREFIX, FERNET_PREFIX)):
+                    continue
+                try:
+                    api_key.key_lookup_hmac = self._lookup_hmac(self._decrypt_key(api_key.key_hash))
+                    backfilled += 1
+                except (InvalidToken, InvalidTag):
+                    continue  # Encrypted under a different key; it can never verify
+            
+            self.db.commit()
+            
+            if backfilled:
+                self.audit_logger.log_event(
+                    event_type="api_key_lookup_backfilled",
+                    event_category="api",
+                    action="backfill_lookup_hmacs",
+                    success=True,
+                    metadata={"backfilled_count": backfilled}
+                )
+            
+            return backfilled
+            
+        except Exception as e:
+            self.audit_logger.log_event(
+                event_type="api_key_lookup_backfill_error",
+                event_category="api",
+                action="backfill_lookup_hmacs",
+                success=False,
+                error_message=str(e)
+            )
+            raise
+    
+    def close(self):
+        """Stop the usage flusher immediately and write any pending usage"""
+        self._usage_stop.set()
+        if self._usage_thread:
+            self._usage_thread.join(timeout=5)
+            self._usage_thread = None
+        self.flush_usage()
+    
+    def invalidate_users(self, user_ids: List[int]):
+        """Forget cached verifications of keys owned by the given users, e.g. after erasure"""
+        self._verification_cache.discard_users(user_ids)
+    
     def rotate_expiring_keys(self, days_before_expiry: int = 7) -> List[Dict[str, Any]]:
         """
         Rotate API keys that are expiring soon
@@ -372,39 +566,66 @@ class APIKeyManager:
         try:
             expiring_date = datetime.utcnow() + timedelta(days=days_before_expiry)
             
-            expiring_keys = self.db.query(APIKey).filter(
-                and_(
-                    APIKey.is_active == True,
-                    APIKey.expires_at <= expiring_date,
-                    APIKey.expires_at > datetime.utcnow()
-                )
-            ).all()
-            
             rotated_keys = []
-            
-            for api_key in expiring_keys:
-                try:
-                    new_key_string, updated_key = self.rotate_api_key(api_key.id)
-                    
-                    rotated_keys.append({
-                        'api_key_id': api_key.id,
-                        'user_id': api_key.user_id,
-                        'name': api_key.name,
-                        'old_expires_at': api_key.expires_at.isoformat(),
-                        'new_expires_at': updated_key.expires_at.isoformat(),
-                        'new_key': new_key_string  # In production, send via secure channel
-                    })
-                    
-                except Exception as e:
-                    self.audit_logger.log_event(
-                        event_type="auto_rotation_failed",
-                        event_category="api",
-                        action="rotate_expiring_keys",
-                        user_id=api_key.user_id,
-                        success=False,
-                        error_message=str(e),
-                        metadata={"api_key_id": api_key.id}
-                    )
+            last_id = 0
+            
+            # Keyset-paginate so only one batch is in memory, committing once per batch;
+            # rows locked by another rotating worker are skipped (FOR UPDATE SKIP LOCKED)
+            while True:
+                batch = self.db.execute(_EXPIRING_BATCH_STMT, {
+                    'expiring_date': expiring_date,
+                    'now': datetime.utcnow(),
+                    'last_id': last_id,
+                    'batch_size': self.rotation_batch_size
+                }).all()
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                new_expires_at = datetime.utcnow() + timedelta(days=30)
+                
+                # Plain rows in, one executemany UPDATE out; no per-object unit-of-work
+                updates = []
+                rotated_batch = []
+                for row in batch:
+                    try:
+                        new_key_string = self._generate_secure_key()
+                        updates.append({
+                            'id': row.id,
+                            'key_hash': self._encrypt_key(new_key_string),
+                            'key_lookup_hmac': self._lookup_hmac(new_key_string),
+                            'expires_at': new_expires_at,
+                            'usage_count': 0,
+                            'last_used': None
+                        })
+                        rotated_batch.append((row.key_hash, {
+                            'api_key_id': row.id,
+                            'user_id': row.user_id,
+                            'name': row.name,
+                            'old_expires_at': row.expires_at.isoformat(),
+                            'new_expires_at': new_expires_at.isoformat(),
+                            'new_key': new_key_string  # In production, send via secure channel
+                        }))
+                        
+                    except Exception as e:
+                        self.audit_logger.log_event(
+                            event_type="auto_rotation_failed",
+                            event_category="api",
+                            action="rotate_expiring_keys",
+                            user_id=row.user_id,
+                            success=False,
+                            error_message=str(e),
+                            metadata={"api_key_id": row.id}
+                        )
+                
+                self.db.bulk_update_mappings(APIKey, updates)
+                self.db.commit()
+                
+                for old_key_hash, key_info in rotated_batch:
+                    self._verification_cache.discard_api_key(key_info['api_key_id'])
+                    self._discard_usage(key_info['api_key_id'])
+                    self._log_rotation(key_info['api_key_id'], key_info['user_id'], key_info['name'],
+                                       old_key_hash, key_info['new_expires_at'])
+                    rotated_keys.append(key_info)
             
             if rotated_keys:
                 self.audit_logger.log_event(
@@ -430,55 +651,184 @@ class APIKeyManager:
             )
             raise
     
+    def _rotate_api_key_nocommit(self, api_key: APIKey, extend_expiration: bool = True) -> str:
+        """Give an API key a new secret in the session without committing; returns the new key"""
+        self._verification_cache.discard_api_key(api_key.id)
+        self._discard_usage(api_key.id)
+        
+        # Generate new key
+        new_api_key_string = self._generate_secure_key()
+        api_key.key_hash = self._encrypt_key(new_api_key_string)
+        api_key.key_lookup_hmac = self._lookup_hmac(new_api_key_string)
+        
+        # Extend expiration if requested
+        if extend_expiration:
+            api_key.expires_at = datetime.utcnow() + timedelta(days=30)
+        
+        # Reset usage statistics
+        api_key.usage_count = 0
+        api_key.last_used = None
+        
+        return new_api_key_string
+    
+    def _log_rotation(self, api_key_id: int, user_id: int, name: str, old_key_hash: str,
+                      new_expires_at: Optional[str]):
+        """Audit a committed key rotation"""
+        self.audit_logger.log_event(
+            event_type="api_key_rotated",
+            event_category="api",
+            action="rotate_api_key",
+            user_id=user_id,
+            success=True,
+            metadata={
+                "api_key_id": api_key_id,
+                "name": name,
+                "old_key_hash": old_key_hash[:10] + "...",  # Log only partial hash
+                "new_expires_at": new_expires_at
+            }
+        )
+    
+    def _find_api_key(self, lookup_hmac: str) -> Optional[APIKey]:
+        """Find the active API key whose lookup HMAC matches a presented key, as a detached snapshot"""
+        params = {'lookup_hmac': lookup_hmac, 'now': datetime.utcnow()}
+        
+        # Single indexed probe on the unique lookup HMAC; the same work whichever key matches.
+        # Core row read: no autoflush of unrelated pending state, no identity-map bookkeeping
+        with self.db.no_autoflush:
+            row = self.db.execute(_VERIFY_STMT, params).first()
+        if row and hmac.compare_digest(row.key_lookup_hmac, lookup_hmac):
+            return self._snapshot_from_row(row)
+        return None
+    
+    def _record_usage(self, api_key_id: int) -> int:
+        """Count one use of an API key; returns uses not yet flushed"""
+        now = datetime.utcnow()
+        with self._usage_lock:
+            uses, _ = self._usage_counters.get(api_key_id, (0, None))
+            self._usage_counters[api_key_id] = (uses + 1, now)
+        return uses + 1
+    
+    def _discard_usage(self, api_key_id: int):
+        """Drop unflushed uses of a key whose usage statistics were reset"""
+        with self._usage_lock:
+            self._usage_counters.pop(api_key_id, None)
+    
+    def flush_usage(self):
+        """Write aggregated API key usage with a single executemany UPDATE"""
+        with self._usage_lock:
+            counters, self._usage_counters = self._usage_counters, {}
+        if not counters:
+            return
+        
+        params = [
+            {'api_key_id': api_key_id, 'uses': uses, 'used_at': used_at}
+            for api_key_id, (uses, used_at) in counters.items()
+        ]
+        try:
+            # Own connection, never the session: this also runs on the flusher thread
+            with self._get_usage_engine().begin() as conn:
+                conn.execute(_USAGE_UPDATE_STMT, params)
+        except Exception as e:
+            self._restore_usage(counters)
+            self.audit_logger.log_event(
+                event_type="api_key_usage_flush_error",
+                event_category="api",
+                action="flush_usage",
+                success=False,
+                error_message=str(e),
+                metadata={"api_key_count": len(params)}
+            )
+    
+    def _restore_usage(self, counters: Dict[int, Tuple[int, datetime]]):
+        """Merge counters from a failed flush back in, so the next flush writes them"""
+        with self._usage_lock:
+            for api_key_id, (uses, used_at) in counters.items():
+                pending_uses, pending_used_at = self._usage_counters.get(api_key_id, (0, used_at))
+                self._usage_counters[api_key_id] = (pending_uses + uses, max(pending_used_at, used_at))
+    
+    def _get_usage_engine(self) -> Engine:
+        """Get the engine used for usage flushes"""
+        if self._usage_engine is None:
+            self._usage_engine = self.db.get_bind()
+        return self._usage_engine
+    
+    def _usage_flush_worker(self, interval: float):
+        """Background worker flushing usage counters"""
+        while not self._usage_stop.wait(interval):
+            self.flush_usage()
+    
+    def _lookup_hmac(self, api_key_string: str) -> str:
+        """Deterministic HMAC-SHA256 of an API key, stored in the indexed lookup column"""
+        return hmac.new(self.hmac_key, api_key_string.encode(), hashlib.sha256).hexdigest()
+    
+    def _get_cached_api_key(self, lookup_hmac: str) -> Optional[APIKey]:
+        """Get the detached snapshot of the API key a token recently verified against"""
+        entry = self._verification_cache.get(lookup_hmac)
+        if entry is None:
+            return None
+        
+        api_key_id, snapshot = entry
+        if snapshot.expires_at and snapshot.expires_at <= datetime.utcnow():
+            self._verification_cache.discard(lookup_hmac)
+            return None
+        
+        return snapshot
+    
+    def _snapshot_from_row(self, row) -> APIKey:
+        """Build a detached API key from a Core row; sessions can merge it with load=False"""
+        mapper = inspect(APIKey)
+        snapshot = mapper.class_manager.new_instance()
+        for attr in mapper.column_attrs:
+            set_committed_value(snapshot, attr.key, row._mapping[attr.columns[0]])
+        make_transient_to_detached(snapshot)
+        # Normalized once per load; every verification against this snapshot reuses it
+        snapshot.scope_set = frozenset(snapshot.scopes or ())
+        snapshot.ip_networks = self._parse_ip_whitelist(snapshot.ip_whitelist)
+        return snapshot
+    
+    def _parse_ip_whitelist(self, ip_whitelist: Optional[List[str]]) -> Tuple:
+        """Parse whitelist entries (addresses or CIDR ranges) into networks; unparsable entries match nothing"""
+        networks = []
+        for entry in ip_whitelist or ():
+            try:
+                networks.append(ipaddress.ip_network(entry, strict=False))
+            except ValueError:
+                continue
+        return tuple(networks)
+    
+    def _ip_allowed(self, client_ip: str, networks: Tuple) -> bool:
+        """Check whether a client address falls inside any whitelisted network"""
+        try:
+            address = ipaddress.ip_address(client_ip)
+        except ValueError:
+            return False
+        return any(address in network for network in networks)
+    
     def _generate_secure_key(self) -> str:
         """Generate cryptographically secure API key"""
-        # Generate 32 bytes of random data and encode as hex
-        random_bytes = secrets.token_bytes(32)
-        return f"nsa_{base64.urlsafe_b64encode(random_bytes).decode().rstrip('=')}"
+        # 32 bytes of random data, URL-safe base64 without padding
+        return f"nsa_{secrets.token_urlsafe(32)}"
     
     def _encrypt_key(self, key: str) -> str:
-        """Encrypt API key for storage"""
-        return self.cipher_suite.encrypt(key.encode()).decode()
+        """Encrypt API key for storage as nonce || ciphertext || tag"""
+        nonce = os.urandom(12)
+        sealed = nonce + self._aesgcm.encrypt(nonce, key.encode(), None)
+        return AESGCM_PREFIX + base64.urlsafe_b64encode(sealed).decode()
     
     def _decrypt_key(self, encrypted_key: str) -> str:
         """Decrypt stored API key"""
-        return self.cipher_suite.decrypt(encrypted_key.encode()).decode()
-    
-    def _rotation_worker(self, check_interval_hours: int):
-        """Background worker for automatic rotation"""
-        while not self._stop_rotation:
-            try:
-                # Check every hour but only rotate based on configured interval
-                time.sleep(3600)  # 1 hour
-                
-                if not self._stop_rotation:
-                    # Rotate keys expiring in the next 7 days
-                    rotated = self.rotate_expiring_keys(days_before_expiry=7)
-                    
-                    if rotated:
-                        # In production, notify users about rotated keys
-                        self._notify_users_about_rotation(rotated)
-                        
-            except Exception as e:
-                self.audit_logger.log_event(
-                    event_type="rotation_worker_error",
-                    event_category="api",
-                    action="automatic_rotation",
-                    success=False,
-                    error_message=str(e)
-                )
-                # Continue running despite errors
-                time.sleep(300)  # Wait 5 minutes before retrying
+        if not encrypted_key.startswith(AESGCM_PREFIX):
+            return self.cipher_suite.decrypt(encrypted_key.encode()).decode()
+        
+        sealed = base64.urlsafe_b64decode(encrypted_key[len(AESGCM_PREFIX):])
+        return self._aesgcm.decrypt(sealed[:12], sealed[12:], None).decode()
     
     def _notify_users_about_rotation(self, rotated_keys: List[Dict[str, Any]]):
         """Notify users about rotated API keys"""
         # Group by user
-        user_rotations = {}
+        user_rotations = defaultdict(list)
         for key_info in rotated_keys:
-            user_id = key_info['user_id']
-            if user_id not in user_rotations:
-                user_rotations[user_id] = []
-            user_rotations[user_id].append(key_info)
+            user_rotations[key_info['user_id']].append(key_info)
         
         # Log notification events (in production, send actual emails/notifications)
         for user_id, keys in user_rotations.items():
@@ -497,28 +847,34 @@ class APIKeyManager:
     def get_api_key_stats(self, user_id: int = None) -> Dict[str, Any]:
         """Get API key usage statistics"""
         try:
-            query = self.db.query(APIKey)
-            if user_id:
-                query = query.filter(APIKey.user_id == user_id)
-            
-            all_keys = query.all()
-            
             now = datetime.utcnow()
+            user_filter = [APIKey.user_id == user_id] if user_id else []
+            
+            # All counters in a single aggregate query
+            counts = self.db.execute(
+                select(
+                    func.count().label('total'),
+                    func.count(case((APIKey.is_active == True, 1))).label('active'),
+                    func.count(case((APIKey.expires_at < now, 1))).label('expired'),
+                    func.count(case((APIKey.expires_at <= now + timedelta(days=7), 1))).label('expiring_soon'),
+                    func.coalesce(func.sum(APIKey.usage_count), 0).label('total_usage')
+                ).select_from(APIKey).where(*user_filter)
+            ).one()
+            
             stats = {
-                'total_keys': len(all_keys),
-                'active_keys': len([k for k in all_keys if k.is_active]),
-                'expired_keys': len([k for k in all_keys if k.is_expired()]),
-                'expiring_soon': len([k for k in all_keys if k.expires_at and k.expires_at <= now + timedelta(days=7)]),
-                'total_usage': sum(k.usage_count for k in all_keys),
+                'total_keys': counts.total,
+                'active_keys': counts.active,
+                'expired_keys': counts.expired,
+                'expiring_soon': counts.expiring_soon,
+                'total_usage': counts.total_usage,
                 'keys_by_scope': {}
             }
             
-            # Count keys by scope
-            for key in all_keys:
-                for scope in key.scopes or []:
-                    if scope not in stats['keys_by_scope']:
-                        stats['keys_by_scope'][scope] = 0
-                    stats['keys_by_scope'][scope] += 1
+            # Count keys by scope; scopes is a portable JSON column, so only it is fetched
+            scope_lists = self.db.execute(select(APIKey.scopes).where(*user_filter)).scalars()
+            stats['keys_by_scope'] = dict(Counter(chain.from_iterable(
+                scopes for scopes in scope_lists if scopes
+            )))
             
             return stats
             
@@ -3,28 +3,116 @@ Comprehensive Audit Logging System
 Provides structured logging for security events, compliance, and operational monitoring
 """
 
-import json
 import logging
+import queue
+import orjson
 import structlog
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, BinaryIO
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, select, delete, func, case, text
 from pythonjsonlogger import jsonlogger
+from logging.handlers import QueueHandler, QueueListener
 import os
+import uuid
+import operator
+import random
+import threading
+import time
+import atexit
 from pathlib import Path
+from collections import deque
+from functools import lru_cache
+from types import MappingProxyType
+from sqlalchemy.engine import Engine
 
-from .models import AuditLog, User
+from .models import AuditLog, User, audit_retention_until
+
+# Naive datetimes are UTC throughout the audit system
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+# Structured logging is process-wide; the listener is created by the first AuditLogger
+_LOGGING_LOCK = threading.Lock()
+_log_listener: Optional[QueueListener] = None
+
+# Shared empty mapping for the event wrappers; callers' additional_data is copied, never mutated
+_NO_METADATA = MappingProxyType({})
+
+# Audit logs are append-only: rows go in through a Core INSERT, bypassing the unit of work
+_INSERT_STMT = AuditLog.__table__.insert()
+
+# Audit writes tolerate losing the last moments on power failure (emergency.log is the fallback)
+_ASYNC_COMMIT_STMT = text('SET LOCAL synchronous_commit = off')
+
+# search_audit_logs filter keys: column and comparison for each allowed filter
+_SEARCH_FILTERS = {
+    'user_id': (AuditLog.user_id, operator.eq),
+    'event_category': (AuditLog.event_category, operator.eq),
+    'event_type': (AuditLog.event_type, operator.eq),
+    'success': (AuditLog.success, operator.eq),
+    'ip_address': (AuditLog.ip_address, operator.eq),
+    'api_key_id': (AuditLog.api_key_id, operator.eq),
+    'start_date': (AuditLog.timestamp, operator.ge),
+    'end_date': (AuditLog.timestamp, operator.le)
+}
+
+
+def _orjson_dumps(obj: Any, **kwargs) -> str:
+    """json.dumps-compatible serializer backed by orjson"""
+    return orjson.dumps(obj, default=str, option=ORJSON_OPTIONS).decode()
 
 
 class AuditLogger:
     """Comprehensive audit logging system"""
     
-    def __init__(self, db_session: Session, log_directory: str = "./logs"):
+    def __init__(self, db_session: Session, log_directory: str = "./logs",
+                 batch_writes: bool = False, engine: Optional[Engine] = None,
+                 flush_interval: float = 0.05, batch_size: int = 256,
+                 max_pending: int = 100_000, drop_summary_interval: float = 60.0,
+                 api_sample_rate: float = 1.0, writer_shards: int = 1):
         self.db = db_session
         self.log_directory = Path(log_directory)
         self.log_directory.mkdir(exist_ok=True)
         
+        # Batched database writes: log_event only enqueues, a background thread inserts
+        self.batch_writes = batch_writes
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._engine = engine
+        # One queue and writer thread per shard; rows are routed by user_id so
+        # writers never share a queue. max_pending is split evenly across shards.
+        # SQLite allows a single writer, so extra shards there would only hit "database is locked".
+        if engine is not None and engine.dialect.name == 'sqlite':
+            writer_shards = 1
+        self.writer_shards = max(1, writer_shards)
+        self._shards = [deque() for _ in range(self.writer_shards)]
+        self._wakeups = [threading.Event() for _ in range(self.writer_shards)]
+        # Bounded queues: past 80% full low-priority rows are dropped, and once full
+        # GDPR events and security/compliance failures are written synchronously
+        self.max_pending = max_pending
+        self._shard_capacity = max(1, max_pending // self.writer_shards)
+        self._drop_threshold = int(self._shard_capacity * 0.8)
+        self.dropped_events = 0
+        self.spilled_events = 0
+        self.drop_summary_interval = drop_summary_interval
+        self._dropped_reported = 0
+        self._last_drop_summary = 0.0
+        self._writer_stop = threading.Event()
+        self._writer_threads = []
+        
+        # Fraction of successful (2xx) API access events that are recorded
+        self.api_sample_rate = api_sample_rate
+        self.sampled_out_api_events = 0
+        self._api_action = lru_cache(maxsize=4096)(lambda method, endpoint: f"{method}_{endpoint}")
+        
+        # Emergency log handle is opened on first use and kept open
+        self._emergency_file = None
+        self._emergency_lock = threading.Lock()
+        
+        # Earliest retention_until known to be in the table; cleanup skips the
+        # database entirely until it passes. None means unknown.
+        self._next_retention_expiry: Optional[datetime] = None
+        
         # Configure structured logging
         self._setup_structured_logging()
         
@@ -35,153 +123,369 @@ class AuditLogger:
         self.gdpr_logger = structlog.get_logger("gdpr")
         self.compliance_logger = structlog.get_logger("compliance")
         self.general_logger = structlog.get_logger("general")
-    
-    def _setup_structured_logging(self):
-        """Configure structured logging with JSON output"""
-        
-        # Create log files for different categories
-        log_files = {
-            'security': self.log_directory / 'security.log',
-            'auth': self.log_directory / 'auth.log',
-            'api': self.log_directory / 'api.log',
-            'gdpr': self.log_directory / 'gdpr.log',
-            'compliance': self.log_directory / 'compliance.log',
-            'general': self.log_directory / 'general.log'
-        }
         
-        # Configure Python logging
-        logging.basicConfig(level=logging.INFO)
-        
-        # JSON formatter
-        json_formatter = jsonlogger.JsonFormatter(
-            '%(asctime)s %(name)s %(levelname)s %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
+        # Category routing table, built once: (info, error) log methods per category
+        self._category_loggers = {
+            'security': self.security_logger,
+            'auth': self.auth_logger,
+            'api': self.api_logger,
+            'gdpr': self.gdpr_logger,
+            'compliance': self.compliance_logger
+        }
+        self._dispatch = {
+            category: (logger.info, logger.error)
+            for category, logger in self._category_loggers.items()
+        }
+        self._default_dispatch = (self.general_logger.info, self.general_logger.error)
         
-        # Create handlers for each log file
-        handlers = {}
-        for category, log_file in log_files.items():
-            handler = logging.FileHandler(log_file)
-            handler.setFormatter(json_formatter)
-            handlers[category] = handler
-        
-        # Configure structlog
-        structlog.configure(
-            processors=[
-                structlog.stdlib.filter_by_level,
-                structlog.stdlib.add_logger_name,
-                structlog.stdlib.add_log_level,
-                structlog.stdlib.PositionalArgumentsFormatter(),
-                structlog.processors.TimeStamper(fmt="iso"),
-                structlog.processors.StackInfoRenderer(),
-                structlog.processors.format_exc_info,
-                structlog.processors.UnicodeDecoder(),
-                structlog.processors.JSONRenderer()
-            ],
-            context_class=dict,
-            logger_factory=structlog.stdlib.LoggerFactory(),
-            wrapper_class=structlog.stdlib.BoundLogger,
-            cache_logger_on_first_use=True,
-        )
+        if batch_writes:
+            for shard in range(self.writer_shards):
+                thread = threading.Thread(target=self._writer_loop, args=(shard,), daemon=True)
+                thread.start()
+                self._writer_threads.append(thread)
+            atexit.register(self.close)
+    
+    def _setup_structured_logging(self):
+        """
+        Configure structured logging with JSON output; this is process-wide, so only
+        the first AuditLogger sets up structlog and the category log files
+        """
+        global _log_listener
         
-        # Add handlers to loggers
-        for category, handler in handlers.items():
-            logger = logging.getLogger(category)
-            logger.addHandler(handler)
-            logger.setLevel(logging.INFO)
+        with _LOGGING_LOCK:
+            if _log_listener is not None:
+                return
+            
+            # Create log files for different categories
+            log_files = {
+                'security': self.log_directory / 'security.log',
+                'auth': self.log_directory / 'auth.log',
+                'api': self.log_directory / 'api.log',
+                'gdpr': self.log_directory / 'gdpr.log',
+                'compliance': self.log_directory / 'compliance.log',
+                'general': self.log_directory / 'general.log'
+            }
+            
+            # Configure Python logging
+            logging.basicConfig(level=logging.INFO)
+            
+            # JSON formatter
+            json_formatter = jsonlogger.JsonFormatter(
+                '%(asctime)s %(name)s %(levelname)s %(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S',
+                json_serializer=_orjson_dumps
+            )
+            
+            # Create handlers for each log file; they only see their own category's records
+            handlers = {}
+            for category, log_file in log_files.items():
+                handler = logging.FileHandler(log_file)
+                handler.setFormatter(json_formatter)
+                handler.addFilter(logging.Filter(category))
+                handlers[category] = handler
+            
+            # Callers only enqueue records; a single listener thread does the file writes
+            log_queue = queue.SimpleQueue()
+            _log_listener = QueueListener(log_queue, *handlers.values(), respect_handler_level=True)
+            queue_handler = QueueHandler(log_queue)
+            
+            # Configure structlog
+            structlog.configure(
+                processors=[
+                    structlog.stdlib.filter_by_level,
+                    structlog.stdlib.add_logger_name,
+                    structlog.stdlib.add_log_level,
+                    structlog.stdlib.PositionalArgumentsFormatter(),
+                    structlog.processors.TimeStamper(fmt="iso"),
+                    structlog.processors.StackInfoRenderer(),
+                    structlog.processors.format_exc_info,
+                    structlog.processors.UnicodeDecoder(),
+                    structlog.processors.JSONRenderer(serializer=_orjson_dumps)
+                ],
+                context_class=dict,
+                logger_factory=structlog.stdlib.LoggerFactory(),
+                wrapper_class=structlog.stdlib.BoundLogger,
+                cache_logger_on_first_use=True,
+            )
+            
+            # Add the queue handler to loggers
+            for category in handlers:
+                logger = logging.getLogger(category)
+                logger.addHandler(queue_handler)
+                logger.setLevel(logging.INFO)
+            
+            _log_listener.start()
+            atexit.register(_log_listener.stop)
     
     def log_event(self, event_type: str, event_category: str, action: str,
                   user_id: Optional[int] = None, success: bool = True,
                   ip_address: Optional[str] = None, user_agent: Optional[str] = None,
                   session_id: Optional[str] = None, api_key_id: Optional[int] = None,
                   resource: Optional[str] = None, error_message: Optional[str] = None,
-                  metadata: Optional[Dict[str, Any]] = None):
+                  metadata: Optional[Dict[str, Any]] = None, critical: bool = False):
         """
-        Log an audit event to both database and structured logs
+        Log an audit event to both database and structured logs; critical events
+        skip the batch queue and are inserted before this returns
         """
+        row = self._build_row(
+            event_type, event_category, action, user_id, success, ip_address,
+            user_agent, session_id, api_key_id, resource, error_message, metadata
+        )
+        # Structured logs are written first so they survive a database outage
+        self._log_to_structured(row)
+        
+        if self.batch_writes:
+            if critical:
+                self._write_batch([row], durable=True)
+            else:
+                self._enqueue(row)
+            return
+        
         try:
-            # Create audit log entry in database
-            audit_log = AuditLog(
-                event_type=event_type,
-                event_category=event_category,
-                action=action,
-                user_id=user_id
-            )
-            
-            # Set optional fields
-            if ip_address:
-                audit_log.ip_address = ip_address
-            if user_agent:
-                audit_log.user_agent = user_agent
-            if session_id:
-                audit_log.session_id = session_id
-            if api_key_id:
-                audit_log.api_key_id = api_key_id
-            if resource:
-                audit_log.resource = resource
-            if error_message:
-                audit_log.error_message = error_message
-            if metadata:
-                audit_log.metadata = metadata
-            
-            audit_log.success = success
-            
-            # Save to database
-            self.db.add(audit_log)
+            self.db.execute(_INSERT_STMT, row)
             self.db.commit()
-            
-            # Log to structured logs
-            self._log_to_structured(audit_log)
-            
         except Exception as e:
             # Fallback logging if database fails
             self._emergency_log(event_type, event_category, action, str(e), user_id)
     
-    def _log_to_structured(self, audit_log: AuditLog):
-        """Log to structured logging system"""
+    def log_event_async(self, event_type: str, event_category: str, action: str,
+                        user_id: Optional[int] = None, success: bool = True,
+                        ip_address: Optional[str] = None, api_key_id: Optional[int] = None,
+                        error_message: Optional[str] = None,
+                        metadata: Optional[Dict[str, Any]] = None):
+        """
+        Queue an audit event for the background writer without touching the session;
+        falls back to a synchronous write when no writer thread is running
+        """
+        if not self._writers_alive():
+            self.log_event(event_type, event_category, action, user_id=user_id, success=success,
+                           ip_address=ip_address, api_key_id=api_key_id,
+                           error_message=error_message, metadata=metadata)
+            return
         
+        row = self._build_row(
+            event_type, event_category, action, user_id, success, ip_address,
+            None, None, api_key_id, None, error_message, metadata
+        )
+        self._log_to_structured(row)
+        self._enqueue(row)
+    
+    def _build_row(self, event_type: str, event_category: str, action: str,
+                   user_id: Optional[int], success: bool, ip_address: Optional[str],
+                   user_agent: Optional[str], session_id: Optional[str],
+                   api_key_id: Optional[int], resource: Optional[str],
+                   error_message: Optional[str], metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Build an audit_logs row for a Core insert"""
+        now = datetime.utcnow()
+        return {
+            'user_id': user_id,
+            'event_type': event_type,
+            'event_category': event_category,
+            'action': action,
+            'resource': resource or None,
+            'ip_address': ip_address or None,
+            'user_agent': user_agent or None,
+            'session_id': session_id or None,
+            'api_key_id': api_key_id or None,
+            'success': success,
+            'error_message': error_message or None,
+            'metadata': metadata or None,
+            'timestamp': now,
+            'retention_until': audit_retention_until(event_category, now)
+        }
+    
+    def _get_engine(self) -> Engine:
+        """Get the engine used for batched writes"""
+        if self._engine is None:
+            self._engine = self.db.get_bind()
+        return self._engine
+    
+    def _writers_alive(self) -> bool:
+        """Check whether the background writer threads are running"""
+        return bool(self._writer_threads) and all(t.is_alive() for t in self._writer_threads)
+    
+    @staticmethod
+    def _must_keep(row: Dict[str, Any]) -> bool:
+        """Check whether a row may never be dropped under backpressure"""
+        # GDPR events are the record of data-subject requests and are always kept
+        if row['event_category'] == 'gdpr':
+            return True
+        if not row['success'] and row['event_category'] in ('security', 'compliance'):
+            return True
+        metadata = row['metadata']
+        return bool(metadata) and metadata.get('severity') in ('high', 'critical')
+    
+    def _enqueue(self, row: Dict[str, Any]):
+        """Queue a row for its shard's writer, shedding low-priority rows when it falls behind"""
+        # System events without a user go to shard 0
+        shard = (row['user_id'] or 0) % self.writer_shards
+        rows = self._shards[shard]
+        pending = len(rows)
+        if pending >= self._drop_threshold and not self._must_keep(row):
+            self.dropped_events += 1
+            return
+        if pending >= self._shard_capacity:
+            # Write synchronously instead of dropping; falls back to the emergency log on failure
+            self.spilled_events += 1
+            self._write_batch([row], durable=self._must_keep(row))
+            return
+        
+        rows.append(row)
+        if pending + 1 >= self.batch_size:
+            self._wakeups[shard].set()
+    
+    def _drain(self, shard: int, limit: int) -> List[Any]:
+        """Pop up to limit items off the front of a shard's queue"""
+        items = []
+        popleft = self._shards[shard].popleft
+        try:
+            for _ in range(limit):
+                items.append(popleft())
+        except IndexError:
+            pass
+        return items
+    
+    def _write_items(self, items: List[Any]):
+        """Insert queued rows, releasing flush() markers once preceding rows are written"""
+        batch = []
+        for item in items:
+            # A flush() marker: everything queued before it is in this batch
+            if isinstance(item, threading.Event):
+                if batch:
+                    self._write_batch(batch, durable=any(map(self._must_keep, batch)))
+                    batch = []
+                item.set()
+                continue
+            batch.append(item)
+        
+        if batch:
+            self._write_batch(batch, durable=any(map(self._must_keep, batch)))
+    
+    def _writer_loop(self, shard: int):
+        """Background worker inserting one shard's queued audit rows in batches"""
+        wakeup = self._wakeups[shard]
+        while not self._writer_stop.is_set():
+            wakeup.wait(self.flush_interval)
+            wakeup.clear()
+            while True:
+                items = self._drain(shard, self.batch_size)
+                if not items:
+                    break
+                self._write_items(items)
+            # Drop summaries are written by a single writer
+            if shard == 0:
+                self._report_dropped()
+    
+    def _report_dropped(self, force: bool = False):
+        """Write a single summary row for events dropped since the last report"""
+        dropped = self.dropped_events - self._dropped_reported
+        if not dropped:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_drop_summary < self.drop_summary_interval:
+            return
+        
+        self._dropped_reported += dropped
+        self._last_drop_summary = now
+        row = self._build_row(
+            'audit_events_dropped', 'security', 'drop_audit_events', None, False, None,
+            None, None, None, None, f"{dropped} audit events dropped under backpressure",
+            {'dropped': dropped, 'total_dropped': self._dropped_reported}
+        )
+        self._log_to_structured(row)
+        self._write_batch([row], durable=True)
+    
+    def _write_batch(self, batch: List[Dict[str, Any]], durable: bool = False):
+        """
+        Insert a batch of audit rows in a single executemany round-trip; durable batches
+        (critical and must-keep rows) wait for the WAL flush like any other commit
+        """
+        try:
+            with self._get_engine().begin() as conn:
+                if not durable and conn.dialect.name == 'postgresql':
+                    # Only this audit transaction skips waiting for the WAL flush
+                    conn.execute(_ASYNC_COMMIT_STMT)
+                conn.execute(_INSERT_STMT, batch)
+        except Exception as e:
+            # Buffer the whole failed batch and write it out with a single flush
+            for row in batch:
+                self._emergency_log(row['event_type'], row['event_category'], row['action'],
+                                    str(e), row['user_id'], flush=False)
+            self._flush_emergency_log()
+    
+    def flush(self, timeout: float = 5.0):
+        """Write all queued audit rows now"""
+        if self._writers_alive():
+            markers = []
+            for rows, wakeup in zip(self._shards, self._wakeups):
+                marker = threading.Event()
+                rows.append(marker)
+                wakeup.set()
+                markers.append(marker)
+            deadline = time.monotonic() + timeout
+            for marker in markers:
+                marker.wait(max(0.0, deadline - time.monotonic()))
+            return
+        
+        for shard in range(self.writer_shards):
+            while True:
+                items = self._drain(shard, self.batch_size)
+                if not items:
+                    break
+                self._write_items(items)
+    
+    def close(self):
+        """Stop the background writer and flush remaining rows"""
+        self._writer_stop.set()
+        for wakeup in self._wakeups:
+            wakeup.set()
+        for thread in self._writer_threads:
+            thread.join(timeout=5)
+        self._writer_threads = []
+        self.flush()
+        self._report_dropped(force=True)
+        with self._emergency_lock:
+            if self._emergency_file is not None:
+                self._emergency_file.close()
+                self._emergency_file = None
+    
+    def _log_to_structured(self, row: Dict[str, Any]):
+        """Log an audit row to the structured logging system"""
         log_data = {
-            'event_id': audit_log.id,
-            'event_type': audit_log.event_type,
-            'action': audit_log.action,
-            'success': audit_log.success,
-            'user_id': audit_log.user_id,
-            'ip_address': audit_log.ip_address,
-            'user_agent': audit_log.user_agent,
-            'session_id': audit_log.session_id,
-            'api_key_id': audit_log.api_key_id,
-            'resource': audit_log.resource,
-            'metadata': audit_log.metadata,
-            'timestamp': audit_log.timestamp.isoformat()
+            'event_id': uuid.uuid4().hex,
+            'event_type': row['event_type'],
+            'action': row['action'],
+            'success': row['success'],
+            'user_id': row['user_id'],
+            'ip_address': row['ip_address'],
+            'user_agent': row['user_agent'],
+            'session_id': row['session_id'],
+            'api_key_id': row['api_key_id'],
+            'resource': row['resource'],
+            'metadata': row['metadata'],
+            'timestamp': row['timestamp']
         }
         
-        if audit_log.error_message:
-            log_data['error_message'] = audit_log.error_message
+        if row['error_message']:
+            log_data['error_message'] = row['error_message']
         
         # Choose appropriate logger based on category
-        logger = self._get_category_logger(audit_log.event_category)
+        info, error = self._dispatch.get(row['event_category'], self._default_dispatch)
         
-        if audit_log.success:
-            logger.info(f"{audit_log.action} completed", **log_data)
+        if row['success']:
+            info(f"{row['action']} completed", **log_data)
         else:
-            logger.error(f"{audit_log.action} failed", **log_data)
+            error(f"{row['action']} failed", **log_data)
     
     def _get_category_logger(self, category: str) -> structlog.BoundLogger:
         """Get appropriate logger for event category"""
-        category_loggers = {
-            'security': self.security_logger,
-            'auth': self.auth_logger,
-            'api': self.api_logger,
-            'gdpr': self.gdpr_logger,
-            'compliance': self.compliance_logger
-        }
-        return category_loggers.get(category, self.general_logger)
+        return self._category_loggers.get(category, self.general_logger)
     
     def _emergency_log(self, event_type: str, event_category: str, action: str, 
-                      error: str, user_id: Optional[int] = None):
+                      error: str, user_id: Optional[int] = None, flush: bool = True):
         """Emergency logging when database is unavailable"""
         emergency_log = {
-            'timestamp': datetime.utcnow().isoformat(),
+            'timestamp': datetime.utcnow(),
             'event_type': event_type,
             'event_category': event_category,
             'action': action,
@@ -189,10 +493,20 @@ class AuditLogger:
             'error': error,
             'emergency': True
         }
+        line = orjson.dumps(emergency_log, default=str, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
         
-        emergency_file = self.log_directory / 'emergency.log'
-        with open(emergency_file, 'a') as f:
-            f.write(json.dumps(emergency_log) + '\n')
+        with self._emergency_lock:
+            if self._emergency_file is None:
+                self._emergency_file = open(self.log_directory / 'emergency.log', 'ab', buffering=1 << 16)
+            self._emergency_file.write(line)
+            if flush:
+                self._emergency_file.flush()
+    
+    def _flush_emergency_log(self):
+        """Write out buffered emergency log lines"""
+        with self._emergency_lock:
+            if self._emergency_file is not None:
+                self._emergency_file.flush()
     
     def log_authentication_event(self, user_id: int, event_type: str, success: bool,
                                 ip_address: str = None, user_agent: str = None,
@@ -214,9 +528,11 @@ class AuditLogger:
                           severity: str = "medium", user_id: int = None,
                           ip_address: str = None, additional_data: Dict[str, Any] = None):
         """Log security-specific events"""
-        metadata = additional_data or {}
-        metadata['severity'] = severity
-        metadata['description'] = description
+        metadata = {
+            **(additional_data or _NO_METADATA),
+            'severity': severity,
+            'description': description
+        }
         
         self.log_event(
             event_type=event_type,
@@ -233,13 +549,13 @@ class AuditLogger:
                       processing_purposes: List[str] = None,
                       additional_data: Dict[str, Any] = None):
         """Log GDPR-specific events"""
-        metadata = additional_data or {}
-        metadata.update({
+        metadata = {
+            **(additional_data or _NO_METADATA),
             'request_type': request_type,
             'status': status,
             'data_categories': data_categories or [],
             'processing_purposes': processing_purposes or []
-        })
+        }
         
         self.log_event(
             event_type=f"gdpr_{request_type}",
@@ -254,7 +570,12 @@ class AuditLogger:
                       response_code: int, user_id: int = None,
                       ip_address: str = None, processing_time: float = None,
                       request_size: int = None, response_size: int = None):
-        """Log API access events"""
+        """Log API access events; successful requests are sampled at api_sample_rate"""
+        if (200 <= response_code < 300 and self.api_sample_rate < 1.0
+                and random.random() >= self.api_sample_rate):
+            self.sampled_out_api_events += 1
+            return
+        
         metadata = {
             'endpoint': endpoint,
             'method': method,
@@ -267,7 +588,7 @@ class AuditLogger:
         self.log_event(
             event_type="api_request",
             event_category="api",
-            action=f"{method}_{endpoint}",
+            action=self._api_action(method, endpoint),
             user_id=user_id,
             success=200 <= response_code < 400,
             ip_address=ip_address,
@@ -281,13 +602,13 @@ class AuditLogger:
                            deadline: datetime = None, 
                            additional_data: Dict[str, Any] = None):
         """Log compliance-related events"""
-        metadata = additional_data or {}
-        metadata.update({
+        metadata = {
+            **(additional_data or _NO_METADATA),
             'regulation': regulation,
             'compliance_status': compliance_status,
             'details': details,
             'deadline': deadline.isoformat() if deadline else None
-        })
+        }
         
         self.log_event(
             event_type=event_type,
@@ -298,72 +619,65 @@ class AuditLogger:
         )
     
     def search_audit_logs(self, filters: Dict[str, Any], 
-                         limit: int = 100, offset: int = 0) -> Dict[str, Any]:
+                         limit: int = 100, offset: int = 0, include_total: bool = False,
+                         after_timestamp: Optional[datetime] = None,
+                         after_id: Optional[int] = None) -> Dict[str, Any]:
         """
         Search audit logs with filters
-        Returns paginated results with metadata
+        Returns paginated results with metadata; logs are read-only row mappings, total_count
+        is only computed when include_total is set, and after_timestamp/after_id continue
+        from a previous page (offset is ignored when they are given)
         """
+        self.flush()
+        
         try:
-            query = self.db.query(AuditLog)
-            
-            # Apply filters
-            if 'user_id' in filters:
-                query = query.filter(AuditLog.user_id == filters['user_id'])
-            
-            if 'event_category' in filters:
-                query = query.filter(AuditLog.event_category == filters['event_category'])
-            
-            if 'event_type' in filters:
-                query = query.filter(AuditLog.event_type == filters['event_type'])
-            
-            if 'success' in filters:
-                query = query.filter(AuditLog.success == filters['success'])
-            
-            if 'ip_address' in filters:
-                query = query.filter(AuditLog.ip_address == filters['ip_address'])
-            
-            if 'start_date' in filters:
-                query = query.filter(AuditLog.timestamp >= filters['start_date'])
-            
-            if 'end_date' in filters:
-                query = query.filter(AuditLog.timestamp <= filters['end_date'])
-            
-            if 'api_key_id' in filters:
-                query = query.filter(AuditLog.api_key_id == filters['api_key_id'])
-            
-            # Get total count
-            total_count = query.count()
-            
-            # Apply pagination and ordering
-            logs = query.order_by(AuditLog.timestamp.desc()).offset(offset).limit(limit).all()
-            
-            # Format results
-            results = []
-            for log in logs:
-                results.append({
-                    'id': log.id,
-                    'event_type': log.event_type,
-                    'event_category': log.event_category,
-                    'action': log.action,
-                    'user_id': log.user_id,
-                    'success': log.success,
-                    'ip_address': log.ip_address,
-                    'user_agent': log.user_agent,
-                    'session_id': log.session_id,
-                    'api_key_id': log.api_key_id,
-                    'resource': log.resource,
-                    'error_message': log.error_message,
-                    'metadata': log.metadata,
-                    'timestamp': log.timestamp.isoformat(),
-                    'retention_until': log.retention_until.isoformat() if log.retention_until else None
-                })
+            # Apply filters; keys outside the whitelist are ignored
+            conditions = []
+            for key, value in filters.items():
+                search_filter = _SEARCH_FILTERS.get(key)
+                if search_filter is not None:
+                    column, op = search_filter
+                    conditions.append(op(column, value))
+            
+            # Counting the whole filtered set is only done on request
+            total_count = None
+            if include_total:
+                total_count = self.db.execute(
+                    select(func.count()).select_from(AuditLog).where(*conditions)
+                ).scalar_one()
+            
+            # Keyset cursor: continue after the last (timestamp, id) of the previous page
+            if after_timestamp is not None and after_id is not None:
+                conditions.append(or_(
+                    AuditLog.timestamp < after_timestamp,
+                    and_(AuditLog.timestamp == after_timestamp, AuditLog.id < after_id)
+                ))
+                # The cursor already positions the page; an offset on top would skip rows
+                offset = 0
+            
+            # Plain row mappings, no ORM objects; one extra row tells whether there is a next page
+            results = self.db.execute(
+                select(AuditLog.__table__)
+                .where(*conditions)
+                .order_by(AuditLog.timestamp.desc(), AuditLog.id.desc())
+                .offset(offset)
+                .limit(limit + 1)
+            ).mappings().all()
+            has_more = len(results) > limit
+            results = results[:limit]
+            
+            next_cursor = None
+            if has_more:
+                last = results[-1]
+                next_cursor = {'after_timestamp': last['timestamp'].isoformat(), 'after_id': last['id']}
             
             return {
                 'logs': results,
                 'total_count': total_count,
                 'limit': limit,
                 'offset': offset,
-                'has_more': total_count > offset + limit
+                'has_more': has_more,
+                'next_cursor': next_cursor
             }
             
         except Exception as e:
@@ -378,58 +692,83 @@ class AuditLogger:
             raise
     
     def generate_compliance_report(self, start_date: datetime, end_date: datetime,
-                                 categories: List[str] = None) -> Dict[str, Any]:
+                                 categories: List[str] = None,
+                                 max_incidents: int = 1000) -> Dict[str, Any]:
         """Generate compliance report for specified period"""
+        self.flush()
+        
         try:
-            query = self.db.query(AuditLog).filter(
-                and_(
-                    AuditLog.timestamp >= start_date,
-                    AuditLog.timestamp <= end_date
+            conditions = [
+                AuditLog.timestamp >= start_date,
+                AuditLog.timestamp <= end_date
+            ]
+            if categories:
+                conditions.append(AuditLog.event_category.in_(categories))
+            
+            # Security incidents: failed or high-severity security events
+            metadata_column = AuditLog.__table__.c.metadata
+            is_incident = and_(
+                AuditLog.event_category == 'security',
+                or_(
+                    AuditLog.success == False,
+                    metadata_column['severity'].as_string().in_(['high', 'critical'])
                 )
             )
             
-            if categories:
-                query = query.filter(AuditLog.event_category.in_(categories))
-            
-            logs = query.all()
-            
-            # Generate statistics
-            total_events = len(logs)
-            successful_events = len([log for log in logs if log.success])
+            # Aggregate in the database instead of loading every row in the window
+            event_count = func.count(AuditLog.id)
+            totals = self.db.execute(
+                select(
+                    event_count,
+                    func.sum(case((AuditLog.success == True, 1), else_=0)),
+                    func.sum(case((AuditLog.event_category == 'security', 1), else_=0)),
+                    func.sum(case((and_(AuditLog.event_type == 'login', AuditLog.success == False), 1), else_=0)),
+                    func.sum(case((is_incident, 1), else_=0))
+                ).where(*conditions)
+            ).one()
+            total_events = totals[0]
+            successful_events = totals[1] or 0
             failed_events = total_events - successful_events
             
-            # Events by category
-            events_by_category = {}
-            events_by_type = {}
-            events_by_user = {}
-            daily_activity = {}
-            
-            for log in logs:
-                # By category
-                if log.event_category not in events_by_category:
-                    events_by_category[log.event_category] = 0
-                events_by_category[log.event_category] += 1
-                
-                # By type
-                if log.event_type not in events_by_type:
-                    events_by_type[log.event_type] = 0
-                events_by_type[log.event_type] += 1
-                
-                # By user
-                if log.user_id:
-                    if log.user_id not in events_by_user:
-                        events_by_user[log.user_id] = 0
-                    events_by_user[log.user_id] += 1
-                
-                # Daily activity
-                day = log.timestamp.date().isoformat()
-                if day not in daily_activity:
-                    daily_activity[day] = 0
-                daily_activity[day] += 1
-            
-            # Security events analysis
-            security_events = [log for log in logs if log.event_category == 'security']
-            failed_logins = [log for log in logs if log.event_type == 'login' and not log.success]
+            events_by_category = dict(self.db.execute(
+                select(AuditLog.event_category, event_count)
+                .where(*conditions)
+                .group_by(AuditLog.event_category)
+            ).all())
+            
+            events_by_type = dict(self.db.execute(
+                select(AuditLog.event_type, event_count)
+                .where(*conditions)
+                .group_by(AuditLog.event_type)
+            ).all())
+            
+            events_by_user = dict(self.db.execute(
+                select(AuditLog.user_id, event_count)
+                .where(*conditions, AuditLog.user_id.isnot(None))
+                .group_by(AuditLog.user_id)
+                .order_by(event_count.desc())
+                .limit(10)
+            ).all())
+            
+            day = func.date(AuditLog.timestamp)
+            daily_activity = {
+                date if isinstance(date, str) else date.isoformat(): count
+                for date, count in self.db.execute(
+                    select(day, event_count).where(*conditions).group_by(day).order_by(day)
+                )
+            }
+            
+            # Only the selective security-incident rows are loaded in full, up to max_incidents
+            incidents = self.db.execute(
+                select(
+                    AuditLog.timestamp, AuditLog.event_type, AuditLog.user_id,
+                    AuditLog.ip_address, AuditLog.error_message, metadata_column
+                )
+                .where(*conditions, is_incident)
+                .order_by(AuditLog.timestamp)
+                .limit(max_incidents)
+            ).all()
+            incidents_count = totals[4] or 0
             
             report = {
                 'period': {
@@ -444,21 +783,22 @@ class AuditLogger:
                 },
                 'events_by_category': events_by_category,
                 'events_by_type': events_by_type,
-                'events_by_user': dict(sorted(events_by_user.items(), key=lambda x: x[1], reverse=True)[:10]),
+                'events_by_user': events_by_user,
                 'daily_activity': daily_activity,
                 'security_analysis': {
-                    'security_events_count': len(security_events),
-                    'failed_login_attempts': len(failed_logins),
+                    'security_events_count': totals[2] or 0,
+                    'failed_login_attempts': totals[3] or 0,
+                    'security_incidents_count': incidents_count,
+                    'incidents_truncated': incidents_count > len(incidents),
                     'security_incidents': [
                         {
-                            'timestamp': log.timestamp.isoformat(),
-                            'event_type': log.event_type,
-                            'user_id': log.user_id,
-                            'ip_address': log.ip_address,
-                            'description': log.error_message or log.metadata.get('description', '')
+                            'timestamp': incident.timestamp.isoformat(),
+                            'event_type': incident.event_type,
+                            'user_id': incident.user_id,
+                            'ip_address': incident.ip_address,
+                            'description': incident.error_message or (incident.metadata or {}).get('description', '')
                         }
-                        for log in security_events
-                        if not log.success or log.metadata.get('severity') in ['high', 'critical']
+                        for incident in incidents
                     ]
                 },
                 'generated_at': datetime.utcnow().isoformat()
@@ -489,27 +829,39 @@ class AuditLogger:
             )
             raise
     
-    def cleanup_expired_logs(self) -> int:
+    def cleanup_expired_logs(self, batch_size: int = 10_000) -> int:
         """Clean up audit logs that have exceeded their retention period"""
+        now = datetime.utcnow()
+        if self._next_retention_expiry is not None and self._next_retention_expiry > now:
+            return 0
+        
+        self.flush()
+        
         try:
-            now = datetime.utcnow()
-            
-            # Find expired logs
-            expired_logs = self.db.query(AuditLog).filter(
-                and_(
-                    AuditLog.retention_until.isnot(None),
-                    AuditLog.retention_until < now
+            expired_ids = select(AuditLog.id).where(
+                AuditLog.retention_until.isnot(None),
+                AuditLog.retention_until < now
+            ).limit(batch_size)
+            
+            # Delete in chunks so each transaction holds its locks only briefly
+            expired_count = 0
+            while True:
+                ids = self.db.execute(expired_ids).scalars().all()
+                if not ids:
+                    break
+                self.db.execute(
+                    delete(AuditLog).where(AuditLog.id.in_(ids)),
+                    execution_options={'synchronize_session': False}
                 )
-            ).all()
+                self.db.commit()
+                expired_count += len(ids)
             
-            expired_count = len(expired_logs)
+            # Rows written from now on expire no earlier than the shortest retention period
+            earliest = self.db.execute(select(func.min(AuditLog.retention_until))).scalar()
+            floor = audit_retention_until('general', now)
+            self._next_retention_expiry = min(earliest, floor) if earliest else floor
             
-            # Delete expired logs
-            if expired_logs:
-                for log in expired_logs:
-                    self.db.delete(log)
-                self.db.commit()
-                
+            if expired_count:
                 self.log_event(
                     event_type="audit_logs_cleaned",
                     event_category="compliance",
@@ -530,43 +882,69 @@ class AuditLogger:
             )
             raise
     
-    def export_user_audit_data(self, user_id: int, format: str = 'json') -> Dict[str, Any]:
-        """Export all audit data for a specific user (GDPR compliance)"""
+    def _iter_user_audit_events(self, user_id: int, chunk_size: int = 1000, limit: Optional[int] = None):
+        """Stream a user's audit events as dicts without building ORM objects; timestamps stay datetimes"""
+        stmt = select(
+            AuditLog.timestamp, AuditLog.event_type, AuditLog.event_category, AuditLog.action,
+            AuditLog.success, AuditLog.ip_address, AuditLog.user_agent, AuditLog.session_id,
+            AuditLog.resource, AuditLog.__table__.c.metadata
+        ).where(AuditLog.user_id == user_id).order_by(AuditLog.id)
+        
+        if limit is not None:
+            # Only the most recent events, still returned oldest first
+            recent_ids = select(AuditLog.id).where(
+                AuditLog.user_id == user_id
+            ).order_by(AuditLog.id.desc()).limit(limit)
+            stmt = stmt.where(AuditLog.id.in_(recent_ids))
+        
+        for row in self.db.execute(stmt.execution_options(yield_per=chunk_size)):
+            yield row._asdict()
+    
+    def export_user_audit_data(self, user_id: int, format: str = 'json',
+                               output: Optional[BinaryIO] = None,
+                               limit: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Export audit data for a specific user (GDPR compliance), optionally only the
+        most recent limit events; when a binary output is given the JSON document is
+        streamed to it instead of returned
+        """
+        self.flush()
+        
         try:
-            user_logs = self.db.query(AuditLog).filter(AuditLog.user_id == user_id).all()
-            
-            if format == 'json':
-                data = []
-                for log in user_logs:
-                    data.append({
-                        'timestamp': log.timestamp.isoformat(),
-                        'event_type': log.event_type,
-                        'event_category': log.event_category,
-                        'action': log.action,
-                        'success': log.success,
-                        'ip_address': log.ip_address,
-                        'user_agent': log.user_agent,
-                        'session_id': log.session_id,
-                        'resource': log.resource,
-                        'metadata': log.metadata
-                    })
-                
-                result = {
-                    'user_id': user_id,
-                    'export_date': datetime.utcnow().isoformat(),
-                    'total_events': len(data),
-                    'events': data
-                }
-            else:
+            if format != 'json':
                 raise ValueError(f"Unsupported export format: {format}")
             
+            result = {
+                'user_id': user_id,
+                'export_date': datetime.utcnow().isoformat()
+            }
+            
+            if output is None:
+                events = list(self._iter_user_audit_events(user_id, limit=limit))
+                for event in events:
+                    event['timestamp'] = event['timestamp'].isoformat()
+                result['total_events'] = len(events)
+                result['events'] = events
+            else:
+                # Write one record at a time so the export never sits in memory; orjson
+                # renders the naive timestamps in the same ISO-8601 form as isoformat()
+                events_count = 0
+                output.write(orjson.dumps(result)[:-1] + b',"events":[')
+                for event in self._iter_user_audit_events(user_id, limit=limit):
+                    if events_count:
+                        output.write(b',')
+                    output.write(orjson.dumps(event, default=str))
+                    events_count += 1
+                output.write(b'],"total_events":%d}' % events_count)
+                result['total_events'] = events_count
+            
             self.log_event(
                 event_type="user_data_exported",
                 event_category="gdpr",
                 action="export_user_audit_data",
                 user_id=user_id,
                 success=True,
-                metadata={'format': format, 'events_count': len(user_logs)}
+                metadata={'format': format, 'events_count': result['total_events']}
             )
             
             return result
@@ -3,12 +3,16 @@ GDPR Compliance System
 Handles data subject rights, consent management, and legal change tracking
 """
 
-import json
 import csv
+import io
+import re
+import orjson
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Tuple
+from functools import partial
+from operator import attrgetter, methodcaller
+from typing import Dict, Any, List, Optional, Tuple, Callable
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, select, insert, update, func, case, true, cast, literal, String
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
@@ -16,13 +20,76 @@ import smtplib
 import uuid
 from pathlib import Path
 
-from .models import User, GDPRRecord, LegalChangeLog, AuditLog
+from .models import User, APIKey, GDPRRecord, LegalChangeLog, AuditLog
 from .audit_logger import AuditLogger
 
+# Retention after consent (7 years) and grace period before erasure (30 days)
+_RETENTION_7Y = timedelta(days=2555)
+_GRACE_30D = timedelta(days=30)
+
+# Most recent audit events included in an access request
+_ACCESS_REQUEST_AUDIT_LIMIT = 10_000
+
+# Users anonymized per UPDATE statement by scheduled deletions
+_ERASURE_BATCH_SIZE = 1000
+
+
+def _flatten_items(data: Dict[str, Any], sep: str = '_'):
+    """Yield (key, value) leaves of nested dicts depth-first; list entries are numbered"""
+    # Explicit stack of (items iterator, key prefix, inside a list) frames instead of recursion
+    stack = [(iter(data.items()), '', False)]
+    while stack:
+        items, prefix, in_list = stack[-1]
+        for k, v in items:
+            key = f"{prefix}{sep}{k}" if prefix else k
+            if isinstance(v, dict):
+                stack.append((iter(v.items()), key, False))
+                break
+            if isinstance(v, list) and not in_list:
+                stack.append((enumerate(v), key, True))
+                break
+            yield key, v
+        else:
+            stack.pop()
+
+
+def _isoformat_of(attr: str):
+    """Accessor returning an optional datetime attribute in ISO-8601 form"""
+    get = attrgetter(attr)
+    def accessor(obj):
+        value = get(obj)
+        return value.isoformat() if value is not None else None
+    return accessor
+
 
 class GDPRCompliance:
     """GDPR Compliance management system"""
     
+    # Legal change versions are "<major>.<minor>"
+    _VERSION_RE = re.compile(r'^(\d+)\.(\d+)$')
+    
+    # Access request categories read straight off the User: (field, accessor) per category
+    _USER_FIELD_PLAN = {
+        'personal_identifiers': (
+            ('user_id', attrgetter('id')),
+            ('username', attrgetter('username')),
+            ('email', attrgetter('email')),
+            ('created_at', _isoformat_of('created_at')),
+            ('updated_at', _isoformat_of('updated_at'))
+        ),
+        # Authentication data (limited for security)
+        'authentication_data': (
+            ('two_factor_enabled', attrgetter('two_factor_enabled')),
+            ('backup_codes_count', lambda user: len(user.backup_codes) if user.backup_codes else 0),
+            ('last_login', _isoformat_of('last_login'))
+        ),
+        'security_data': (
+            ('failed_login_attempts', attrgetter('failed_login_attempts')),
+            ('account_locked', methodcaller('is_locked')),
+            ('api_keys_count', lambda user: len(user.api_keys))
+        )
+    }
+    
     def __init__(self, db_session: Session, audit_logger: AuditLogger, 
                  email_config: Dict[str, Any], data_controller_info: Dict[str, Any]):
         self.db = db_session
@@ -30,6 +97,10 @@ class GDPRCompliance:
         self.email_config = email_config
         self.data_controller_info = data_controller_info
         
+        # Called with the erased user ids once an erasure is committed, so caches
+        # outside this session (verified API keys, 2FA state) can drop those users
+        self._users_erased_hooks: List[Callable[[List[int]], None]] = []
+        
         # Data categories for GDPR compliance
         self.data_categories = {
             'personal_identifiers': ['name', 'username', 'email', 'user_id'],
@@ -49,13 +120,32 @@ class GDPRCompliance:
             'analytics': 'Service improvement and analytics',
             'communication': 'Service-related communications'
         }
+        
+        # Default category selection for access requests, computed once
+        self._data_category_keys = frozenset(self.data_categories)
+        
+        # Collectors for access request categories, in output order; the subset needed
+        # for a given category selection is resolved once and cached
+        self._category_collectors = {
+            **{
+                category: partial(self._collect_fields, fields)
+                for category, fields in self._USER_FIELD_PLAN.items()
+            },
+            'audit_data': self._collect_audit_data,
+            'gdpr_data': self._collect_gdpr_data
+        }
+        self._collector_plans = {}
+        
+        # Portability exports directory; created on the first export only
+        self._export_dir = Path("./exports")
+        self._export_dir_created = False
     
     def record_consent(self, user_id: int, consent_type: str, given: bool,
                       mechanism: str, data_categories: List[str] = None,
                       processing_purposes: List[str] = None) -> GDPRRecord:
         """Record user consent for data processing"""
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -70,14 +160,15 @@ class GDPRCompliance:
                 consent_mechanism=mechanism,
                 status='completed'
             )
-            gdpr_record.processed_date = datetime.utcnow()
+            now = datetime.utcnow()
+            gdpr_record.processed_date = now
             
             # Update user consent status
             if given:
                 user.gdpr_consent = True
-                user.gdpr_consent_date = datetime.utcnow()
+                user.gdpr_consent_date = now
                 # Set data retention period (7 years for financial data, 3 years for general)
-                user.data_retention_until = datetime.utcnow() + timedelta(days=2555)  # 7 years
+                user.data_retention_until = now + _RETENTION_7Y
             else:
                 user.gdpr_consent = False
                 gdpr_record.consent_withdrawn = True
@@ -112,7 +203,7 @@ class GDPRCompliance:
     def withdraw_consent(self, user_id: int, reason: str = None) -> GDPRRecord:
         """Process consent withdrawal"""
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -125,13 +216,14 @@ class GDPRCompliance:
                 status='completed',
                 notes=reason
             )
-            gdpr_record.processed_date = datetime.utcnow()
+            now = datetime.utcnow()
+            gdpr_record.processed_date = now
             
             # Update user consent status
             user.gdpr_consent = False
             
             # Mark for data deletion (30 days grace period)
-            user.data_retention_until = datetime.utcnow() + timedelta(days=30)
+            user.data_retention_until = now + _GRACE_30D
             
             self.db.add(gdpr_record)
             self.db.commit()
@@ -162,7 +254,7 @@ class GDPRCompliance:
                              response_format: str = 'json') -> Tuple[GDPRRecord, Dict[str, Any]]:
         """Process data subject access request (Article 15)"""
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -175,8 +267,9 @@ class GDPRCompliance:
                 status='processing'
             )
             
+            # Flush for the record id; it is committed once, in its final state
             self.db.add(gdpr_record)
-            self.db.commit()
+            self.db.flush()
             
             # Collect user data
             user_data = self._collect_user_data(user_id, requested_categories)
@@ -222,7 +315,7 @@ class GDPRCompliance:
                                     justification: str) -> GDPRRecord:
         """Process data rectification request (Article 16)"""
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -236,7 +329,7 @@ class GDPRCompliance:
             )
             
             self.db.add(gdpr_record)
-            self.db.commit()
+            self.db.flush()
             
             # Apply updates (with validation)
             updated_fields = []
@@ -249,11 +342,12 @@ class GDPRCompliance:
                     updated_fields.append(field)
             
             if updated_fields:
-                user.updated_at = datetime.utcnow()
+                now = datetime.utcnow()
+                user.updated_at = now
                 
                 # Update GDPR record
                 gdpr_record.status = 'completed'
-                gdpr_record.processed_date = datetime.utcnow()
+                gdpr_record.processed_date = now
                 gdpr_record.rectification_completed = True
                 gdpr_record.response_data = {
                     'updated_fields': updated_fields,
@@ -297,7 +391,7 @@ class GDPRCompliance:
                               immediate: bool = False) -> GDPRRecord:
         """Process data erasure request (Article 17 - Right to be forgotten)"""
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -311,8 +405,9 @@ class GDPRCompliance:
             )
             
             self.db.add(gdpr_record)
-            self.db.commit()
+            self.db.flush()
             
+            now = datetime.utcnow()
             if immediate:
                 # Perform immediate erasure
                 self._perform_data_erasure(user_id)
@@ -320,12 +415,14 @@ class GDPRCompliance:
                 gdpr_record.erasure_completed = True
             else:
                 # Schedule for erasure (30 days notice period)
-                user.data_retention_until = datetime.utcnow() + timedelta(days=30)
+                user.data_retention_until = now + _GRACE_30D
                 gdpr_record.status = 'scheduled'
                 gdpr_record.notes += f" - Scheduled for erasure on {user.data_retention_until.isoformat()}"
             
-            gdpr_record.processed_date = datetime.utcnow()
+            gdpr_record.processed_date = now
             self.db.commit()
+            if immediate:
+                self._notify_users_erased([user_id])
             
             self.audit_logger.log_gdpr_event(
                 user_id=user_id,
@@ -358,7 +455,7 @@ class GDPRCompliance:
     def process_portability_request(self, user_id: int, export_format: str = 'json') -> Tuple[GDPRRecord, str]:
         """Process data portability request (Article 20)"""
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -372,26 +469,31 @@ class GDPRCompliance:
             )
             
             self.db.add(gdpr_record)
-            self.db.commit()
+            self.db.flush()
             
             # Export user data in portable format
             export_data = self._export_portable_data(user_id, export_format)
             
             # Save export file
-            export_filename = f"user_{user_id}_data_export_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{export_format}"
-            export_path = Path(f"./exports/{export_filename}")
-            export_path.parent.mkdir(exist_ok=True)
+            now = datetime.utcnow()
+            export_filename = f"user_{user_id}_data_export_{now.strftime('%Y%m%d_%H%M%S')}.{export_format}"
+            if not self._export_dir_created:
+                self._export_dir.mkdir(exist_ok=True)
+                self._export_dir_created = True
+            export_path = self._export_dir / export_filename
             
             if export_format == 'json':
-                with open(export_path, 'w') as f:
-                    json.dump(export_data, f, indent=2, default=str)
+                # orjson serializes datetimes and UUIDs natively; str() covers anything else
+                export_path.write_bytes(orjson.dumps(
+                    export_data, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+                ))
             elif export_format == 'csv':
                 # Flatten data for CSV export
                 self._save_as_csv(export_data, export_path)
             
             # Update GDPR record
             gdpr_record.status = 'completed'
-            gdpr_record.processed_date = datetime.utcnow()
+            gdpr_record.processed_date = now
             gdpr_record.portability_provided = True
             gdpr_record.response_data = {'export_file': export_filename}
             
@@ -431,15 +533,17 @@ class GDPRCompliance:
         """Log important legal changes"""
         try:
             # Determine version number
-            latest_version = self.db.query(LegalChangeLog).filter(
-                LegalChangeLog.change_type == change_type
-            ).order_by(LegalChangeLog.created_at.desc()).first()
+            latest_version = self.db.execute(
+                select(LegalChangeLog.version, LegalChangeLog.id)
+                .where(LegalChangeLog.change_type == change_type)
+                .order_by(LegalChangeLog.created_at.desc())
+                .limit(1)
+            ).first()
             
             if latest_version and latest_version.version:
-                try:
-                    major, minor = latest_version.version.split('.')
-                    new_version = f"{major}.{int(minor) + 1}"
-                except:
+                if (m := self._VERSION_RE.match(latest_version.version)):
+                    new_version = f"{m[1]}.{int(m[2]) + 1}"
+                else:
                     new_version = "1.1"
             else:
                 new_version = "1.0"
@@ -489,52 +593,54 @@ class GDPRCompliance:
     
     def process_scheduled_deletions(self) -> List[Dict[str, Any]]:
         """Process users scheduled for data deletion"""
+        user_ids = []
         try:
             now = datetime.utcnow()
+            now_iso = now.isoformat()
             
-            # Find users scheduled for deletion
-            users_to_delete = self.db.query(User).filter(
-                and_(
-                    User.data_retention_until.isnot(None),
+            # Find users scheduled for deletion; only the columns reported back are loaded.
+            # NULL retention dates never satisfy "<= now", and the consent predicate matches
+            # ix_users_retention_due so the partial index can be used.
+            users_to_delete = self.db.execute(
+                select(User.id, User.username, User.email).where(
                     User.data_retention_until <= now,
                     User.gdpr_consent == False
                 )
             ).all()
             
             deleted_users = []
-            
-            for user in users_to_delete:
-                try:
-                    # Perform data erasure
-                    self._perform_data_erasure(user.id)
-                    
-                    # Create completion record
-                    gdpr_record = GDPRRecord(
-                        user_id=user.id,
-                        request_type='erasure',
-                        status='completed',
-                        erasure_completed=True,
-                        processed_date=now,
-                        notes='Automatic deletion due to consent withdrawal'
-                    )
-                    self.db.add(gdpr_record)
-                    
-                    deleted_users.append({
-                        'user_id': user.id,
-                        'username': user.username,
-                        'email': user.email,
-                        'deletion_date': now.isoformat()
-                    })
-                    
-                except Exception as e:
-                    self.audit_logger.log_gdpr_event(
-                        user_id=user.id,
-                        request_type='erasure',
-                        status='failed',
-                        additional_data={'error': str(e)}
-                    )
-            
+            completion_records = []
+            
+            # Anonymize the whole batch with set-based UPDATEs, then record each erasure
+            user_ids = [user_id for user_id, _, _ in users_to_delete]
+            self._erase_users(user_ids)
+            
+            for user_id, username, email in users_to_delete:
+                # Completion record, inserted with the others after the loop
+                completion_records.append({
+                    'user_id': user_id,
+                    'request_type': 'erasure',
+                    'status': 'completed',
+                    'erasure_completed': True,
+                    'processed_date': now,
+                    'notes': 'Automatic deletion due to consent withdrawal'
+                })
+                
+                deleted_users.append({
+                    'user_id': user_id,
+                    'username': username,
+                    'email': email,
+                    'deletion_date': now_iso
+                })
+            
+            if completion_records:
+                self.db.execute(insert(GDPRRecord), completion_records)
             self.db.commit()
+            self._notify_users_erased(user_ids)
+            
+            # Only audited as completed once the erasure is committed
+            for user_id in user_ids:
+                self._log_erasure_completed(user_id)
             
             if deleted_users:
                 self.audit_logger.log_gdpr_event(
@@ -550,78 +656,74 @@ class GDPRCompliance:
             return deleted_users
             
         except Exception as e:
+            self.db.rollback()
             self.audit_logger.log_gdpr_event(
                 user_id=None,
                 request_type='scheduled_deletion',
                 status='failed',
-                additional_data={'error': str(e)}
+                additional_data={'error': str(e), 'attempted_user_ids': user_ids}
             )
             raise
     
     def _collect_user_data(self, user_id: int, requested_categories: List[str] = None) -> Dict[str, Any]:
         """Collect all user data for access requests"""
-        user = self.db.query(User).filter(User.id == user_id).first()
+        user = self.db.get(User, user_id)
         if not user:
             return {}
         
-        categories_to_include = requested_categories or list(self.data_categories.keys())
+        categories_to_include = (
+            frozenset(requested_categories) if requested_categories else self._data_category_keys
+        )
         
         user_data = {
             'user_id': user_id,
             'export_date': datetime.utcnow().isoformat(),
             'data_controller': self.data_controller_info,
-            'categories': {},
-            'processing_purposes': {k: v for k, v in self.processing_purposes.items()},
+            'categories': {
+                category: collect(user)
+                for category, collect in self._collectors_for(categories_to_include)
+            },
+            'processing_purposes': dict(self.processing_purposes),
             'legal_basis': 'consent' if user.gdpr_consent else 'legitimate_interest',
             'retention_period': user.data_retention_until.isoformat() if user.data_retention_until else None
         }
         
-        # Personal identifiers
-        if 'personal_identifiers' in categories_to_include:
-            user_data['categories']['personal_identifiers'] = {
-                'user_id': user.id,
-                'username': user.username,
-                'email': user.email,
-                'created_at': user.created_at.isoformat(),
-                'updated_at': user.updated_at.isoformat()
-            }
-        
-        # Authentication data (limited for security)
-        if 'authentication_data' in categories_to_include:
-            user_data['categories']['authentication_data'] = {
-                'two_factor_enabled': user.two_factor_enabled,
-                'backup_codes_count': len(user.backup_codes) if user.backup_codes else 0,
-                'last_login': user.last_login.isoformat() if user.last_login else None
-            }
-        
-        # Security data
-        if 'security_data' in categories_to_include:
-            user_data['categories']['security_data'] = {
-                'failed_login_attempts': user.failed_login_attempts,
-                'account_locked': user.is_locked(),
-                'api_keys_count': len(user.api_keys)
-            }
-        
-        # Audit data (recent logs only)
-        if 'audit_data' in categories_to_include:
-            recent_logs = self.audit_logger.export_user_audit_data(user_id)
-            user_data['categories']['audit_data'] = recent_logs
-        
-        # GDPR records
-        if 'gdpr_data' in categories_to_include:
-            gdpr_records = self.db.query(GDPRRecord).filter(GDPRRecord.user_id == user_id).all()
-            user_data['categories']['gdpr_data'] = [
-                {
-                    'request_type': record.request_type,
-                    'request_date': record.request_date.isoformat(),
-                    'status': record.status,
-                    'processed_date': record.processed_date.isoformat() if record.processed_date else None
-                }
-                for record in gdpr_records
-            ]
-        
         return user_data
     
+    def _collectors_for(self, categories: frozenset) -> Tuple[Tuple[str, Any], ...]:
+        """Get the (category, collector) pairs for a category selection"""
+        # Keyed by the known categories only, so the cache holds at most one plan per subset
+        key = frozenset(categories & self._category_collectors.keys())
+        plan = self._collector_plans.get(key)
+        if plan is None:
+            plan = self._collector_plans[key] = tuple(
+                (category, collect) for category, collect in self._category_collectors.items()
+                if category in key
+            )
+        return plan
+    
+    @staticmethod
+    def _collect_fields(fields: Tuple[Tuple[str, Any], ...], user: User) -> Dict[str, Any]:
+        """Collect one category's fields from the user following its field plan"""
+        return {field: accessor(user) for field, accessor in fields}
+    
+    def _collect_audit_data(self, user: User) -> Dict[str, Any]:
+        """Audit data (recent logs only)"""
+        return self.audit_logger.export_user_audit_data(user.id, limit=_ACCESS_REQUEST_AUDIT_LIMIT)
+    
+    def _collect_gdpr_data(self, user: User) -> List[Dict[str, Any]]:
+        """GDPR records"""
+        gdpr_records = self.db.query(GDPRRecord).filter(GDPRRecord.user_id == user.id).all()
+        return [
+            {
+                'request_type': record.request_type,
+                'request_date': record.request_date.isoformat(),
+                'status': record.status,
+                'processed_date': record.processed_date.isoformat() if record.processed_date else None
+            }
+            for record in gdpr_records
+        ]
+    
     def _export_portable_data(self, user_id: int, format: str) -> Dict[str, Any]:
         """Export user data in portable format"""
         # Get complete user data
@@ -641,52 +743,66 @@ class GDPRCompliance:
     
     def _save_as_csv(self, data: Dict[str, Any], file_path: Path):
         """Save data as CSV format"""
-        flattened_data = []
-        
-        def flatten_dict(d, parent_key='', sep='_'):
-            items = []
-            for k, v in d.items():
-                new_key = f"{parent_key}{sep}{k}" if parent_key else k
-                if isinstance(v, dict):
-                    items.extend(flatten_dict(v, new_key, sep=sep).items())
-                elif isinstance(v, list):
-                    for i, item in enumerate(v):
-                        if isinstance(item, dict):
-                            items.extend(flatten_dict(item, f"{new_key}_{i}", sep=sep).items())
-                        else:
-                            items.append((f"{new_key}_{i}", item))
-                else:
-                    items.append((new_key, v))
-            return dict(items)
-        
-        flat_data = flatten_dict(data)
-        
-        with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['Field', 'Value'])
-            for key, value in flat_data.items():
-                writer.writerow([key, str(value)])
+        # Render in memory and write the file in one call, as the JSON export does
+        buffer = io.StringIO(newline='')
+        writer = csv.writer(buffer)
+        writer.writerow(['Field', 'Value'])
+        writer.writerows((key, str(value)) for key, value in _flatten_items(data))
+        file_path.write_bytes(buffer.getvalue().encode('utf-8'))
     
     def _perform_data_erasure(self, user_id: int):
         """Perform complete data erasure for user"""
-        user = self.db.query(User).filter(User.id == user_id).first()
-        if not user:
-            return
-        
+        if self._erase_users([user_id]):
+            self._log_erasure_completed(user_id)
+    
+    def _erase_users(self, user_ids: List[int]) -> int:
+        """Anonymize users and deactivate their API keys in batched UPDATEs; returns users erased"""
         # Anonymize user data instead of hard deletion (for audit trail)
-        user.username = f"deleted_user_{user_id}"
-        user.email = f"deleted_{user_id}@example.com"
-        user.password_hash = None
-        user.two_factor_secret = None
-        user.backup_codes = None
-        user.data_retention_until = None
-        
-        # Deactivate API keys
-        for api_key in user.api_keys:
-            api_key.is_active = False
+        user_id_text = cast(User.id, String)
+        erased = 0
+        for start in range(0, len(user_ids), _ERASURE_BATCH_SIZE):
+            batch = user_ids[start:start + _ERASURE_BATCH_SIZE]
+            result = self.db.execute(
+                update(User).where(User.id.in_(batch)).values(
+                    username=literal('deleted_user_') + user_id_text,
+                    email=literal('deleted_') + user_id_text + literal('@example.com'),
+                    password_hash=None,
+                    two_factor_secret=None,
+                    backup_codes=None,
+                    data_retention_until=None
+                )
+            )
+            erased += result.rowcount
+            
+            # Deactivate API keys
+            self.db.execute(
+                update(APIKey).where(APIKey.user_id.in_(batch)).values(is_active=False)
+            )
         
+        return erased
+    
+    def on_users_erased(self, hook: Callable[[List[int]], None]):
+        """Register a callback invoked with the ids of users whose erasure was committed"""
+        self._users_erased_hooks.append(hook)
+    
+    def _notify_users_erased(self, user_ids: List[int]):
+        """Run the erasure hooks; the erasure is already committed, so failures are only audited"""
+        if not user_ids:
+            return
+        for hook in self._users_erased_hooks:
+            try:
+                hook(user_ids)
+            except Exception as e:
+                self.audit_logger.log_gdpr_event(
+                    user_id=None,
+                    request_type='erasure_cache_eviction',
+                    status='failed',
+                    additional_data={'error': str(e), 'user_ids': user_ids}
+                )
+    
+    def _log_erasure_completed(self, user_id: int):
+        """Audit a completed erasure"""
         # Note: Audit logs are kept for compliance but user data is anonymized
-        
         self.audit_logger.log_gdpr_event(
             user_id=user_id,
             request_type='data_erasure_completed',
@@ -697,40 +813,52 @@ class GDPRCompliance:
     def get_gdpr_dashboard(self, user_id: int = None) -> Dict[str, Any]:
         """Get GDPR compliance dashboard data"""
         try:
-            # Overall statistics
-            total_requests = self.db.query(GDPRRecord).count()
-            pending_requests = self.db.query(GDPRRecord).filter(
-                GDPRRecord.status.in_(['pending', 'processing'])
-            ).count()
-            
-            # Requests by type
-            request_types = {}
-            for request_type in ['consent', 'access', 'rectification', 'erasure', 'portability']:
-                count = self.db.query(GDPRRecord).filter(
-                    GDPRRecord.request_type == request_type
-                ).count()
-                request_types[request_type] = count
-            
-            # Recent legal changes
-            recent_changes = self.db.query(LegalChangeLog).order_by(
-                LegalChangeLog.created_at.desc()
-            ).limit(10).all()
+            request_types = ['consent', 'access', 'rectification', 'erasure', 'portability']
             
             # Users scheduled for deletion
-            scheduled_deletions = self.db.query(User).filter(
+            scheduled_deletions = select(func.count()).select_from(User).where(
                 and_(
                     User.data_retention_until.isnot(None),
                     User.data_retention_until > datetime.utcnow()
                 )
-            ).count()
+            ).scalar_subquery()
+            
+            # Overall statistics and requests by type
+            stats = select(
+                func.count().label('total'),
+                func.count(case((GDPRRecord.status.in_(['pending', 'processing']), 1))).label('pending'),
+                *[
+                    func.count(case((GDPRRecord.request_type == request_type, 1))).label(request_type)
+                    for request_type in request_types
+                ],
+                scheduled_deletions.label('scheduled_deletions')
+            ).select_from(GDPRRecord).subquery('stats')
+            
+            # Recent legal changes; only the displayed columns are loaded
+            recent = select(
+                LegalChangeLog.id, LegalChangeLog.change_type, LegalChangeLog.title,
+                LegalChangeLog.version, LegalChangeLog.created_at,
+                LegalChangeLog.implementation_status, LegalChangeLog.compliance_deadline
+            ).order_by(LegalChangeLog.created_at.desc()).limit(10).subquery('recent')
+            
+            # One round-trip: the single stats row outer-joined to up to 10 recent changes
+            rows = self.db.execute(
+                select(stats, recent)
+                .select_from(stats.outerjoin(recent, true()))
+                .order_by(recent.c.created_at.desc())
+            ).all()
+            counts = rows[0]
+            recent_changes = [row for row in rows if row.id is not None]
             
             dashboard = {
                 'overview': {
-                    'total_gdpr_requests': total_requests,
-                    'pending_requests': pending_requests,
-                    'scheduled_deletions': scheduled_deletions
+                    'total_gdpr_requests': counts.total,
+                    'pending_requests': counts.pending,
+                    'scheduled_deletions': counts.scheduled_deletions
+                },
+                'requests_by_type': {
+                    request_type: counts._mapping[request_type] for request_type in request_types
                 },
-                'requests_by_type': request_types,
                 'recent_legal_changes': [
                     {
                         'id': change.id,
@@ -747,9 +875,12 @@ class GDPRCompliance:
             
             # User-specific data if requested
             if user_id:
-                user_requests = self.db.query(GDPRRecord).filter(
-                    GDPRRecord.user_id == user_id
-                ).order_by(GDPRRecord.request_date.desc()).all()
+                user_requests = self.db.execute(
+                    select(
+                        GDPRRecord.id, GDPRRecord.request_type, GDPRRecord.status,
+                        GDPRRecord.request_date, GDPRRecord.processed_date
+                    ).where(GDPRRecord.user_id == user_id).order_by(GDPRRecord.request_date.desc())
+                ).all()
                 
                 dashboard['user_requests'] = [
                     {
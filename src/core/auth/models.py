@@ -3,11 +3,23 @@ Database models for authentication, audit logging, and GDPR compliance
 """
 
 from datetime import datetime, timedelta
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON
+from enum import IntEnum
+from sqlalchemy import (
+    Column, Integer, SmallInteger, String, Boolean, DateTime, Text, ForeignKey, JSON, Index, LargeBinary
+)
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
+import hmac
+import secrets
+import hashlib
+from functools import lru_cache
+from itertools import chain
+import zlib
+import orjson
 import pyotp
 import qrcode
 from io import BytesIO
@@ -15,6 +27,65 @@ import base64
 
 Base = declarative_base()
 
+# Low zlib level: most of the size reduction on JSON payloads for little CPU
+GDPR_RESPONSE_COMPRESSION_LEVEL = 3
+
+# Array columns: binary JSONB on PostgreSQL (indexable, comparable), plain JSON elsewhere
+JSONDocument = JSON().with_variant(JSONB(), 'postgresql')
+
+
+@lru_cache(maxsize=8192)
+def _get_totp(secret):
+    """Shared TOTP instance per secret; rotated secrets simply stop being looked up"""
+    return pyotp.TOTP(secret)
+
+
+def backup_code_digest(code):
+    """SHA-256 hex digest under which a backup code is stored; case, spaces and dashes are ignored"""
+    normalized = ''.join(code.split()).replace('-', '').upper()
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def remaining_backup_codes(backup_codes, code):
+    """Stored backup codes left after spending code, or None if it matches none of them"""
+    if not backup_codes or not code:
+        return None
+    
+    # Constant-time comparison against every stored digest; codes stored before
+    # hashing was introduced are plaintext and hashed here
+    candidate = backup_code_digest(code)
+    matched = None
+    for backup_code in backup_codes:
+        stored = backup_code if len(backup_code) == 64 else backup_code_digest(backup_code)
+        if hmac.compare_digest(stored, candidate):
+            matched = backup_code
+    
+    if matched is None:
+        return None
+    return [c for c in backup_codes if c != matched]
+
+
+@lru_cache(maxsize=8)
+def _totp_window(valid_window):
+    """TOTP counter offsets ordered by likelihood of matching (aligned clocks first)"""
+    return (0, *chain.from_iterable((-i, i) for i in range(1, valid_window + 1)))
+
+
+def verify_totp(secret, token, valid_window=1):
+    """Verify a TOTP token against a base32 secret"""
+    if not secret or not token:
+        return False
+    
+    totp = _get_totp(secret)
+    now = datetime.now()
+    candidate = str(token).encode()
+    
+    # Check the current time step first, then step outwards; stop on the first match
+    for offset in _totp_window(valid_window):
+        if hmac.compare_digest(candidate, totp.at(now, offset).encode()):
+            return True
+    return False
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -27,7 +98,9 @@ class User(Base):
     # 2FA Settings
     two_factor_enabled = Column(Boolean, default=False)
     two_factor_secret = Column(String(32))
-    backup_codes = Column(JSON)  # Array of backup codes
+    backup_codes = Column(JSONDocument)  # Array of backup code digests
+    # Bumped on every backup_codes change; consuming a code is a compare-and-swap on it
+    backup_codes_version = Column(Integer, nullable=False, default=0, server_default='0')
     
     # Security
     failed_login_attempts = Column(Integer, default=0)
@@ -46,6 +119,12 @@ class User(Base):
     audit_logs = relationship("AuditLog", back_populates="user")
     gdpr_records = relationship("GDPRRecord", back_populates="user")
     
+    __table_args__ = (
+        # Partial index for the scheduled-deletion scan: only users without consent are indexed
+        Index('ix_users_retention_due', data_retention_until,
+              postgresql_where=(gdpr_consent == False), sqlite_where=(gdpr_consent == False)),
+    )
+    
     def set_password(self, password):
         """Set password hash"""
         self.password_hash = generate_password_hash(password)
@@ -64,32 +143,34 @@ class User(Base):
         if not self.two_factor_secret:
             self.generate_2fa_secret()
         
-        totp = pyotp.TOTP(self.two_factor_secret)
+        totp = _get_totp(self.two_factor_secret)
         return totp.provisioning_uri(
             name=self.email,
             issuer_name=issuer_name
         )
     
-    def verify_2fa_token(self, token):
+    def verify_2fa_token(self, token, valid_window=1):
         """Verify 2FA token"""
-        if not self.two_factor_secret:
-            return False
-        
-        totp = pyotp.TOTP(self.two_factor_secret)
-        return totp.verify(token, valid_window=1)
+        return verify_totp(self.two_factor_secret, token, valid_window)
     
     def verify_backup_code(self, code):
         """Verify and consume backup code"""
-        if not self.backup_codes or code not in self.backup_codes:
+        remaining = remaining_backup_codes(self.backup_codes, code)
+        if remaining is None:
             return False
         
-        self.backup_codes.remove(code)
+        self.backup_codes = remaining
+        self.backup_codes_version = (self.backup_codes_version or 0) + 1
         return True
     
     def generate_backup_codes(self, count=10):
-        """Generate new backup codes"""
-        self.backup_codes = [str(uuid.uuid4())[:8] for _ in range(count)]
-        return self.backup_codes
+        """Generate new backup codes; only their SHA-256 digests are stored"""
+        # One urandom read: 5 random bytes per code, each exactly 8 base32 characters
+        raw = secrets.token_bytes(count * 5)
+        codes = [base64.b32encode(raw[i:i + 5]).decode() for i in range(0, len(raw), 5)]
+        self.backup_codes = [backup_code_digest(code) for code in codes]
+        self.backup_codes_version = (self.backup_codes_version or 0) + 1
+        return codes
     
     def is_locked(self):
         """Check if account is locked"""
@@ -107,16 +188,22 @@ class User(Base):
         self.failed_login_attempts = 0
 
 
+def api_key_digest(key):
+    """SHA-256 hex digest of an API key; keys are high-entropy, so no slow KDF is needed"""
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
 class APIKey(Base):
     __tablename__ = 'api_keys'
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     key_hash = Column(String(128), unique=True, nullable=False)
+    key_lookup_hmac = Column(String(64), unique=True, index=True)  # HMAC-SHA256 of the key for indexed lookup
     name = Column(String(100), nullable=False)
     
     # Permissions and Scope
-    scopes = Column(JSON)  # Array of allowed scopes
+    scopes = Column(JSONDocument)  # Array of allowed scopes
     rate_limit = Column(Integer, default=1000)  # Requests per hour
     
     # Lifecycle
@@ -132,22 +219,32 @@ class APIKey(Base):
     # Relationships
     user = relationship("User", back_populates="api_keys")
     
+    __table_args__ = (
+        # Small partial index for the periodic expiring-key rotation scan
+        Index('ix_api_keys_expiring', expires_at,
+              postgresql_where=(is_active == True), sqlite_where=(is_active == True)),
+        # Per-user key listing filtered on is_active
+        Index('ix_api_keys_user_active', user_id, is_active),
+    )
+    
     def __init__(self, user_id, name, scopes=None, expires_days=30):
         self.user_id = user_id
         self.name = name
         self.scopes = scopes or []
         self.expires_at = datetime.utcnow() + timedelta(days=expires_days)
-        self.key_hash = self.generate_key()
+        self.generate_key()
     
     def generate_key(self):
         """Generate new API key"""
         key = str(uuid.uuid4()) + str(uuid.uuid4()).replace('-', '')
-        self.key_hash = generate_password_hash(key)
+        self.key_hash = api_key_digest(key)
         return key
     
     def verify_key(self, key):
         """Verify API key"""
-        return check_password_hash(self.key_hash, key)
+        if not self.key_hash or not key:
+            return False
+        return hmac.compare_digest(self.key_hash, api_key_digest(key))
     
     def is_expired(self):
         """Check if API key is expired"""
@@ -163,6 +260,58 @@ class APIKey(Base):
         self.last_used = datetime.utcnow()
 
 
+class GDPRRequestType(IntEnum):
+    CONSENT = 1
+    CONSENT_WITHDRAWAL = 2
+    ACCESS = 3
+    RECTIFICATION = 4
+    ERASURE = 5
+    PORTABILITY = 6
+
+
+class GDPRStatus(IntEnum):
+    PENDING = 1
+    PROCESSING = 2
+    COMPLETED = 3
+    SCHEDULED = 4
+    REJECTED = 5
+    FAILED = 6
+
+
+class IntEnumName(TypeDecorator):
+    """SMALLINT column for an IntEnum; accepts members or names, reads back lowercase names"""
+    
+    impl = SmallInteger
+    cache_ok = True
+    
+    def __init__(self, enum_class):
+        super().__init__()
+        self.enum_class = enum_class
+    
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, self.enum_class):
+            return int(value)
+        try:
+            return int(self.enum_class[value.upper()])
+        except KeyError:
+            raise ValueError(f"Invalid {self.enum_class.__name__}: {value!r}") from None
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self.enum_class(value).name.lower()
+
+
+def audit_retention_until(event_category, now=None):
+    """Get retention deadline for an audit event (7 years for financial data, 3 years for general logs)"""
+    now = now or datetime.utcnow()
+    if event_category in ['financial', 'compliance']:
+        return now + timedelta(days=2555)  # 7 years
+    return now + timedelta(days=1095)  # 3 years
+
+
 class AuditLog(Base):
     __tablename__ = 'audit_logs'
     
@@ -195,17 +344,23 @@ class AuditLog(Base):
     # Relationships
     user = relationship("User", back_populates="audit_logs")
     
+    __table_args__ = (
+        # Compliance report filters: per-category counts and failed-login lookups over a time window
+        Index('ix_audit_logs_category_timestamp', event_category, timestamp),
+        Index('ix_audit_logs_type_success_timestamp', event_type, success, timestamp),
+        # Per-user audit trail (exports, access requests), newest first
+        Index('ix_audit_logs_user_timestamp', user_id, timestamp.desc()),
+        # Expired-log cleanup scan
+        Index('ix_audit_logs_retention_until', retention_until),
+    )
+    
     def __init__(self, event_type, event_category, action, user_id=None, **kwargs):
         self.event_type = event_type
         self.event_category = event_category
         self.action = action
         self.user_id = user_id
         
-        # Set retention period (7 years for financial data, 3 years for general logs)
-        if event_category in ['financial', 'compliance']:
-            self.retention_until = datetime.utcnow() + timedelta(days=2555)  # 7 years
-        else:
-            self.retention_until = datetime.utcnow() + timedelta(days=1095)  # 3 years
+        self.retention_until = audit_retention_until(event_category)
         
         for key, value in kwargs.items():
             if hasattr(self, key):
@@ -219,16 +374,16 @@ class GDPRRecord(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     
     # Request Details
-    request_type = Column(String(30), nullable=False)  # consent, access, rectification, erasure, portability
+    request_type = Column(IntEnumName(GDPRRequestType), nullable=False)  # consent, access, rectification, erasure, portability
     request_date = Column(DateTime, default=datetime.utcnow)
     processed_date = Column(DateTime)
-    status = Column(String(20), default='pending')  # pending, processing, completed, rejected
+    status = Column(IntEnumName(GDPRStatus), default='pending')  # pending, processing, completed, scheduled, rejected, failed
     
     # Legal Basis
     legal_basis = Column(String(50))  # consent, contract, legal_obligation, vital_interests, public_task, legitimate_interests
     
     # Processing Details
-    data_categories = Column(JSON)  # Array of data categories involved
+    data_categories = Column(JSONDocument)  # Array of data categories involved
     processing_purposes = Column(JSON)  # Array of processing purposes
     third_parties = Column(JSON)  # Array of third parties data is shared with
     
@@ -244,7 +399,7 @@ class GDPRRecord(Base):
     portability_provided = Column(Boolean, default=False)
     
     # Response Details
-    response_data = Column(JSON)
+    response_data_compressed = Column(LargeBinary)  # zlib-compressed JSON, see response_data
     response_format = Column(String(20))  # json, xml, csv, pdf
     
     # Metadata
@@ -255,6 +410,11 @@ class GDPRRecord(Base):
     # Relationships
     user = relationship("User", back_populates="gdpr_records")
     
+    __table_args__ = (
+        # Per-user request history, newest first, without a sort step
+        Index('ix_gdpr_records_user_date', user_id, request_date.desc()),
+    )
+    
     def __init__(self, user_id, request_type, **kwargs):
         self.user_id = user_id
         self.request_type = request_type
@@ -262,6 +422,22 @@ class GDPRRecord(Base):
         for key, value in kwargs.items():
             if hasattr(self, key):
                 setattr(self, key, value)
+    
+    @property
+    def response_data(self):
+        """Response payload, decompressed on access"""
+        if self.response_data_compressed is None:
+            return None
+        return orjson.loads(zlib.decompress(self.response_data_compressed))
+    
+    @response_data.setter
+    def response_data(self, value):
+        """Store the response payload as compressed JSON"""
+        if value is None:
+            self.response_data_compressed = None
+        else:
+            payload = orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+            self.response_data_compressed = zlib.compress(payload, GDPR_RESPONSE_COMPRESSION_LEVEL)
 
 
 class LegalChangeLog(Base):
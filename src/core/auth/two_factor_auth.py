@@ -8,35 +8,118 @@ import qrcode
 import smtplib
 import uuid
 import secrets
+import hmac
+import threading
+import orjson
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
 from io import BytesIO
 import base64
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import inspect, select, update
 from sqlalchemy.orm import Session
 
-from .models import User, AuditLog
+from .models import User, AuditLog, verify_totp, remaining_backup_codes
 from .audit_logger import AuditLogger
 
 
+# Shared pool for outgoing verification emails
+email_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="2fa-email")
+
+# Each email worker thread keeps its authenticated SMTP session open between messages
+_smtp_local = threading.local()
+SMTP_TIMEOUT = 10
+
+# Email verification codes expire after 10 minutes and allow 3 attempts
+EMAIL_TOKEN_TTL = 600
+EMAIL_TOKEN_MAX_ATTEMPTS = 3
+
+# Re-reads allowed when a concurrent login changes the backup codes mid-verification
+BACKUP_CODE_CAS_ATTEMPTS = 3
+
+# Only the columns behind _auth_state, so the login path does not hydrate a full User
+_AUTH_STATE_STMT = select(User.id, User.two_factor_enabled, User.two_factor_secret, User.backup_codes)
+
+
+def _auth_state(user) -> Dict[str, Any]:
+    """2FA state needed to verify logins and report status, from a User or a _AUTH_STATE_STMT row"""
+    return {
+        'enabled': bool(user.two_factor_enabled),
+        'secret': user.two_factor_secret,
+        'backup_codes_count': len(user.backup_codes) if user.backup_codes else 0
+    }
+
+
+class UserAuthCache:
+    """
+    Redis-backed cache of a user's 2FA state (enabled flag, TOTP secret, backup code count);
+    the secret is encrypted with the given cipher (e.g. Fernet) before it leaves the process
+    """
+    
+    def __init__(self, client, ttl: int = 300, cipher=None, prefix: str = "2fa:user:"):
+        self.client = client
+        self.ttl = ttl
+        self.cipher = cipher
+        self.prefix = prefix
+    
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}{user_id}"
+    
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get the cached 2FA state, or None on a miss"""
+        raw = self.client.get(self._key(user_id))
+        if raw is None:
+            return None
+        state = orjson.loads(raw)
+        if self.cipher and state['secret']:
+            try:
+                state['secret'] = self.cipher.decrypt(state['secret'].encode()).decode()
+            except Exception:
+                # Written under another key (e.g. a rotated one): treat as a miss
+                return None
+        return state
+    
+    def set(self, user) -> Dict[str, Any]:
+        """Cache the user's 2FA state and return it"""
+        state = _auth_state(user)
+        cached = state
+        if self.cipher and user.two_factor_secret:
+            cached = {**state, 'secret': self.cipher.encrypt(user.two_factor_secret.encode()).decode()}
+        self.client.setex(self._key(user.id), self.ttl, orjson.dumps(cached))
+        return state
+    
+    def invalidate(self, user_id: int):
+        """Drop the cached state after a 2FA change"""
+        self.client.delete(self._key(user_id))
+
+
 class TwoFactorAuth:
     """Two-Factor Authentication service"""
     
-    def __init__(self, db_session: Session, email_config: Dict[str, Any], audit_logger: AuditLogger):
+    def __init__(self, db_session: Session, email_config: Dict[str, Any], audit_logger: AuditLogger,
+                 auth_cache: Optional[UserAuthCache] = None, redis_client=None):
         self.db = db_session
         self.email_config = email_config
         self.audit_logger = audit_logger
-        self.email_tokens = {}  # In production, use Redis or database
+        # Email tokens live in Redis when a client is given (shared across workers,
+        # expired by Redis); the in-process dict is for single-process deployments
+        self.redis = redis_client
+        self.email_tokens = {}
+        # Optional cache of 2FA state for login verification and status checks
+        self.auth_cache = auth_cache
     
-    def enable_2fa_totp(self, user_id: int, issuer_name: str = "NovaSuite-AI") -> Tuple[str, str, list]:
+    def enable_2fa_totp(self, user_id: int, issuer_name: str = "NovaSuite-AI",
+                        qr: bool = True) -> Tuple[str, str, list]:
         """
         Enable TOTP-based 2FA for user
-        Returns: (secret, qr_code_data_uri, backup_codes)
+        Returns: (secret, qr_code_data_uri, backup_codes); with qr=False the otpauth:// URI
+        is returned in place of the QR image so the client can render it
         """
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -44,11 +127,14 @@ class TwoFactorAuth:
             secret = user.generate_2fa_secret()
             backup_codes = user.generate_backup_codes()
             
-            # Generate QR code
-            qr_code_uri = self._generate_qr_code(user, issuer_name)
+            # Generate QR code, unless the client renders it from the URI
+            provisioning_uri = user.get_2fa_uri(issuer_name)
+            if qr:
+                provisioning_uri = self._generate_qr_code(provisioning_uri)
             
             # Save changes
             self.db.commit()
+            self._invalidate_cached_state(user_id)
             
             # Log the event
             self.audit_logger.log_event(
@@ -60,7 +146,7 @@ class TwoFactorAuth:
                 metadata={"method": "totp", "issuer": issuer_name}
             )
             
-            return secret, qr_code_uri, backup_codes
+            return secret, provisioning_uri, backup_codes
             
         except Exception as e:
             self.audit_logger.log_event(
@@ -78,13 +164,14 @@ class TwoFactorAuth:
         Verify TOTP token and fully enable 2FA
         """
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
             if user.verify_2fa_token(token):
                 user.two_factor_enabled = True
                 self.db.commit()
+                self._invalidate_cached_state(user_id)
                 
                 self.audit_logger.log_event(
                     event_type="2fa_enabled",
@@ -92,7 +179,8 @@ class TwoFactorAuth:
                     action="enable_2fa_totp_confirmed",
                     user_id=user_id,
                     success=True,
-                    metadata={"method": "totp"}
+                    metadata={"method": "totp"},
+                    critical=True
                 )
                 
                 return True
@@ -124,7 +212,7 @@ class TwoFactorAuth:
         Disable 2FA after verification
         """
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -134,13 +222,15 @@ class TwoFactorAuth:
                 user.two_factor_secret = None
                 user.backup_codes = None
                 self.db.commit()
+                self._invalidate_cached_state(user_id)
                 
                 self.audit_logger.log_event(
                     event_type="2fa_disabled",
                     event_category="security",
                     action="disable_2fa",
                     user_id=user_id,
-                    success=True
+                    success=True,
+                    critical=True
                 )
                 
                 return True
@@ -173,7 +263,7 @@ class TwoFactorAuth:
         Returns: token_id for verification
         """
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -181,16 +271,20 @@ class TwoFactorAuth:
             code = f"{secrets.randbelow(1000000):06d}"
             token_id = str(uuid.uuid4())
             
-            # Store token (in production, use Redis with expiration)
-            self.email_tokens[token_id] = {
-                'user_id': user_id,
-                'code': code,
-                'expires_at': datetime.utcnow() + timedelta(minutes=10),
-                'attempts': 0
-            }
+            # Store token
+            if self.redis is not None:
+                self.redis.setex(self._email_token_key(token_id), EMAIL_TOKEN_TTL,
+                                 orjson.dumps({'user_id': user_id, 'code': code}))
+            else:
+                self.email_tokens[token_id] = {
+                    'user_id': user_id,
+                    'code': code,
+                    'expires_at': datetime.utcnow() + timedelta(seconds=EMAIL_TOKEN_TTL),
+                    'attempts': 0
+                }
             
-            # Send email
-            self._send_verification_email(user.email, code)
+            # Send email in the background; SMTP latency stays off the request path
+            email_executor.submit(self._send_verification_email_async, token_id, user_id, user.email, code)
             
             self.audit_logger.log_event(
                 event_type="email_2fa_sent",
@@ -219,27 +313,19 @@ class TwoFactorAuth:
         Verify email verification code
         """
         try:
-            if token_id not in self.email_tokens:
-                return False
-            
-            token_data = self.email_tokens[token_id]
-            
-            # Check expiration
-            if datetime.utcnow() > token_data['expires_at']:
-                del self.email_tokens[token_id]
-                return False
-            
-            # Check attempts limit
-            if token_data['attempts'] >= 3:
-                del self.email_tokens[token_id]
+            if self.redis is not None:
+                token_data = self._claim_redis_email_attempt(token_id)
+            else:
+                token_data = self._claim_local_email_attempt(token_id)
+            if token_data is None:
                 return False
             
-            token_data['attempts'] += 1
-            
             # Verify code
-            if token_data['code'] == code:
+            if hmac.compare_digest(token_data['code'].encode(), code.encode()):
                 user_id = token_data['user_id']
-                del self.email_tokens[token_id]
+                if not self._consume_email_token(token_id):
+                    # Another request already used this code
+                    return False
                 
                 self.audit_logger.log_event(
                     event_type="email_2fa_verified",
@@ -272,25 +358,70 @@ class TwoFactorAuth:
             )
             raise
     
+    def _email_token_key(self, token_id: str) -> str:
+        return f"e2fa:{token_id}"
+    
+    def _claim_redis_email_attempt(self, token_id: str) -> Optional[Dict[str, Any]]:
+        """Count a verification attempt atomically in Redis; returns the token if it may be checked"""
+        key = self._email_token_key(token_id)
+        attempts_key = f"{key}:attempts"
+        pipe = self.redis.pipeline()
+        pipe.get(key)
+        pipe.incr(attempts_key)
+        pipe.expire(attempts_key, EMAIL_TOKEN_TTL)
+        data, attempts, _ = pipe.execute()
+        
+        if data is None:
+            return None
+        if attempts > EMAIL_TOKEN_MAX_ATTEMPTS:
+            self.redis.delete(key, attempts_key)
+            return None
+        return orjson.loads(data)
+    
+    def _claim_local_email_attempt(self, token_id: str) -> Optional[Dict[str, Any]]:
+        """Count a verification attempt against the in-process token store"""
+        token_data = self.email_tokens.get(token_id)
+        if token_data is None:
+            return None
+        
+        # Check expiration and attempts limit
+        if (datetime.utcnow() > token_data['expires_at']
+                or token_data['attempts'] >= EMAIL_TOKEN_MAX_ATTEMPTS):
+            self.email_tokens.pop(token_id, None)
+            return None
+        
+        token_data['attempts'] += 1
+        return token_data
+    
+    def _consume_email_token(self, token_id: str) -> bool:
+        """Delete a token; False when it was already gone"""
+        if self.redis is not None:
+            key = self._email_token_key(token_id)
+            pipe = self.redis.pipeline()
+            pipe.delete(key)
+            pipe.delete(f"{key}:attempts")
+            deleted, _ = pipe.execute()
+            return bool(deleted)
+        return self.email_tokens.pop(token_id, None) is not None
+    
     def verify_2fa_login(self, user_id: int, token: str, token_type: str = "totp") -> bool:
         """
         Verify 2FA during login
         Supports TOTP tokens, backup codes, and email codes
         """
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if not user or not user.two_factor_enabled:
+            state = self._get_2fa_state(user_id)
+            if not state or not state['enabled']:
                 return False
             
             verified = False
             method_used = token_type
             
             if token_type == "totp":
-                verified = user.verify_2fa_token(token)
+                verified = verify_totp(state['secret'], token)
             elif token_type == "backup":
-                verified = user.verify_backup_code(token)
-                if verified:
-                    self.db.commit()  # Save backup code consumption
+                # Backup codes are consumed, so they are always checked against the database
+                verified = self._consume_backup_code(user_id, token)
             elif token_type == "email":
                 # For email, token should be token_id:code format
                 if ':' in token:
@@ -325,7 +456,7 @@ class TwoFactorAuth:
         Regenerate backup codes after verification
         """
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
+            user = self.db.get(User, user_id)
             if not user:
                 raise ValueError("User not found")
             
@@ -333,13 +464,15 @@ class TwoFactorAuth:
             if user.verify_2fa_token(verification_token):
                 backup_codes = user.generate_backup_codes()
                 self.db.commit()
+                self._invalidate_cached_state(user_id)
                 
                 self.audit_logger.log_event(
                     event_type="backup_codes_regenerated",
                     event_category="security",
                     action="regenerate_backup_codes",
                     user_id=user_id,
-                    success=True
+                    success=True,
+                    critical=True
                 )
                 
                 return backup_codes
@@ -366,10 +499,62 @@ class TwoFactorAuth:
             )
             raise
     
-    def _generate_qr_code(self, user: User, issuer_name: str) -> str:
-        """Generate QR code data URI for 2FA setup"""
-        uri = user.get_2fa_uri(issuer_name)
+    def _get_2fa_state(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get a user's 2FA state from the cache, loading and caching it on a miss"""
+        if self.auth_cache is not None:
+            state = self.auth_cache.get(user_id)
+            if state is not None:
+                return state
         
+        # Reuse the User if the session already holds it loaded (e.g. during login),
+        # otherwise fetch just the 2FA columns
+        user = self.db.identity_map.get(self.db.identity_key(User, user_id))
+        if user is None or inspect(user).expired:
+            user = self.db.execute(_AUTH_STATE_STMT.where(User.id == user_id)).first()
+        if not user:
+            return None
+        if self.auth_cache is not None:
+            return self.auth_cache.set(user)
+        return _auth_state(user)
+    
+    def _consume_backup_code(self, user_id: int, code: str) -> bool:
+        """
+        Spend a backup code with a compare-and-swap on backup_codes_version, so two
+        concurrent logins can never both spend the same code (on any database)
+        """
+        for _ in range(BACKUP_CODE_CAS_ATTEMPTS):
+            row = self.db.execute(
+                select(User.backup_codes, User.backup_codes_version).where(User.id == user_id)
+            ).first()
+            remaining = remaining_backup_codes(row.backup_codes, code) if row else None
+            if remaining is None:
+                return False
+            
+            result = self.db.execute(
+                update(User)
+                .where(User.id == user_id, User.backup_codes_version == row.backup_codes_version)
+                .values(backup_codes=remaining, backup_codes_version=row.backup_codes_version + 1),
+                execution_options={'synchronize_session': False}
+            )
+            self.db.commit()
+            if result.rowcount == 1:
+                self._invalidate_cached_state(user_id)
+                return True
+            # Another login changed the codes first: re-read, the code may since be spent
+        return False
+    
+    def invalidate_users(self, user_ids: List[int]):
+        """Drop cached 2FA state of users changed outside this class, e.g. by erasure"""
+        for user_id in user_ids:
+            self._invalidate_cached_state(user_id)
+    
+    def _invalidate_cached_state(self, user_id: int):
+        """Drop cached 2FA state after a change is committed"""
+        if self.auth_cache is not None:
+            self.auth_cache.invalidate(user_id)
+    
+    def _generate_qr_code(self, uri: str) -> str:
+        """Generate QR code data URI for a 2FA provisioning URI"""
         qr = qrcode.QRCode(
             version=1,
             error_correction=qrcode.constants.ERROR_CORRECT_L,
@@ -389,6 +574,22 @@ class TwoFactorAuth:
         img_data = base64.b64encode(buffer.getvalue()).decode()
         return f"data:image/png;base64,{img_data}"
     
+    def _send_verification_email_async(self, token_id: str, user_id: int, email: str, code: str):
+        """Background task sending a verification email, invalidating the token on failure"""
+        try:
+            self._send_verification_email(email, code)
+        except Exception as e:
+            self._consume_email_token(token_id)
+            self.audit_logger.log_event(
+                event_type="email_2fa_error",
+                event_category="security",
+                action="send_email_verification",
+                user_id=user_id,
+                success=False,
+                error_message=str(e),
+                metadata={"token_id": token_id}
+            )
+    
     def _send_verification_email(self, email: str, code: str):
         """Send verification code via email"""
         try:
@@ -415,27 +616,60 @@ class TwoFactorAuth:
             
             msg.attach(MIMEText(body, 'html'))
             
-            # Send email
-            with smtplib.SMTP(self.email_config['smtp_server'], self.email_config['smtp_port']) as server:
-                server.starttls()
-                server.login(self.email_config['smtp_user'], self.email_config['smtp_password'])
-                server.send_message(msg)
-                
+            # Send email; a connection the server has since closed is reopened once
+            try:
+                self._smtp_connection().send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self._close_smtp_connection()
+                self._smtp_connection().send_message(msg)
+            
         except Exception as e:
             raise Exception(f"Failed to send verification email: {str(e)}")
     
+    def _smtp_connection(self) -> smtplib.SMTP:
+        """Get this thread's SMTP connection, connecting and logging in on first use"""
+        config_key = (self.email_config['smtp_server'], self.email_config['smtp_port'],
+                      self.email_config['smtp_user'])
+        cached = getattr(_smtp_local, 'connection', None)
+        if cached is not None:
+            if cached[0] == config_key:
+                return cached[1]
+            self._close_smtp_connection()
+        
+        server = smtplib.SMTP(self.email_config['smtp_server'], self.email_config['smtp_port'],
+                              timeout=SMTP_TIMEOUT)
+        try:
+            server.starttls()
+            server.login(self.email_config['smtp_user'], self.email_config['smtp_password'])
+        except Exception:
+            server.close()
+            raise
+        _smtp_local.connection = (config_key, server)
+        return server
+    
+    @staticmethod
+    def _close_smtp_connection():
+        """Drop this thread's SMTP connection"""
+        cached = getattr(_smtp_local, 'connection', None)
+        _smtp_local.connection = None
+        if cached is not None:
+            try:
+                cached[1].quit()
+            except (smtplib.SMTPException, OSError):
+                cached[1].close()
+    
     def get_2fa_status(self, user_id: int) -> Dict[str, Any]:
         """Get current 2FA status for user"""
         try:
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if not user:
+            state = self._get_2fa_state(user_id)
+            if not state:
                 raise ValueError("User not found")
             
             return {
-                'enabled': user.two_factor_enabled,
-                'has_secret': bool(user.two_factor_secret),
-                'backup_codes_count': len(user.backup_codes) if user.backup_codes else 0,
-                'setup_complete': user.two_factor_enabled and bool(user.two_factor_secret)
+                'enabled': state['enabled'],
+                'has_secret': bool(state['secret']),
+                'backup_codes_count': state['backup_codes_count'],
+                'setup_complete': state['enabled'] and bool(state['secret'])
             }
             
         except Exception as e:
@@ -0,0 +1,25 @@
+"""
+NovaSuite-AI Database Initialization
+Creates the authentication, audit logging, and GDPR tables
+"""
+
+import os
+
+from sqlalchemy import create_engine
+
+from core.auth.models import Base
+
+
+def init_db(database_url: str = None):
+    """Create all tables that do not exist yet"""
+    database_url = database_url or os.environ.get('DATABASE_URL') or 'sqlite:///novasuite.db'
+    engine = create_engine(database_url)
+    try:
+        Base.metadata.create_all(engine)
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    init_db()
+    print("Database tables created")
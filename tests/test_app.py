@@ -0,0 +1,192 @@
+"""
+Tests para la aplicación Flask de NovaSuite-AI
+"""
+
+import pytest
+import os
+import sys
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+@pytest.fixture(scope="module")
+def app_module(tmp_path_factory):
+    """Import the Flask app against a throwaway SQLite database"""
+    tmp_path = tmp_path_factory.mktemp("app")
+    env = {
+        'DATABASE_URL': f"sqlite:///{tmp_path / 'app.db'}",
+        'INIT_DB': '1',
+        'RUN_CLEANUP': '0',
+        'REDIS_URL': ''
+    }
+    cwd = os.getcwd()
+    os.chdir(tmp_path)  # audit and export directories are created relative to cwd
+    try:
+        with patch.dict(os.environ, env):
+            import app
+    finally:
+        os.chdir(cwd)
+    yield app
+    app.rate_flush_stop.set()
+
+
+@pytest.fixture
+def rate_limits(app_module):
+    """Isolated rate-limit state, with the background flusher paused"""
+    saved = dict(app_module._BUCKETS), set(app_module._blocked)
+    app_module._BUCKETS.clear()
+    app_module._blocked.clear()
+    app_module._pending_hits.clear()
+    with patch.object(app_module, 'RATE_FLUSH_INTERVAL', 3600):
+        yield app_module
+    app_module._BUCKETS.clear()
+    app_module._BUCKETS.update(saved[0])
+    app_module._blocked.clear()
+    app_module._blocked.update(saved[1])
+
+
+def test_sqlite_pragmas_apply_to_every_connection(app_module):
+    """Test the app engine runs all SQLite transactions in WAL mode with NORMAL sync"""
+    with app_module.db_engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+
+
+def test_slow_audit_writes_not_reported(app_module):
+    """Test slow queries are audited, except audit writes which would report themselves"""
+    conn = Mock(info={})
+    
+    def run_slow(statement):
+        conn.info['query_start_time'] = [0.0]  # perf_counter origin: always slow
+        app_module.after_cursor_execute(conn, None, statement, None, None, False)
+    
+    with patch.object(app_module.audit_logger, 'log_event') as log_event:
+        run_slow("INSERT INTO audit_logs (event_type) VALUES (?)")
+        assert not log_event.called
+        run_slow("SELECT * FROM users")
+        assert log_event.call_args.kwargs['event_type'] == 'slow_query'
+
+
+def test_backfill_task_logs_errors(app_module):
+    """Test the one-shot lookup backfill reports a missing schema instead of raising"""
+    from sqlalchemy.exc import OperationalError
+    error = OperationalError("SELECT", {}, Exception("no such table: api_keys"))
+    
+    with patch.object(app_module.api_key_manager, 'backfill_lookup_hmacs', side_effect=error):
+        with patch.object(app_module.app.logger, 'exception') as log_exception:
+            app_module.backfill_task()
+    
+    assert log_exception.called
+
+
+class TestRateLimiting:
+    """Tests for the in-process token bucket rate limiter"""
+    
+    def test_requests_counted_until_blocked(self, rate_limits):
+        """Test queued hits are drained into buckets and block the client at capacity"""
+        rate_limits.register_rate_limit('test_scope', 3, 3600)
+        
+        for _ in range(3):
+            assert rate_limits.check_rate('test_scope', '10.0.0.1')
+        rate_limits.flush_rate_counters()
+        
+        assert not rate_limits._pending_hits
+        assert not rate_limits.check_rate('test_scope', '10.0.0.1')
+        assert rate_limits.check_rate('test_scope', '10.0.0.2')
+    
+    def test_refilled_buckets_are_pruned(self, rate_limits):
+        """Test buckets back at capacity are evicted while blocked ones are kept"""
+        rate_limits.register_rate_limit('test_scope', 2, 1)
+        rate_limits.check_rate('test_scope', 'idle')
+        for _ in range(5):
+            rate_limits.check_rate('test_scope', 'busy')
+        rate_limits.flush_rate_counters()
+        
+        bucket = rate_limits._BUCKETS[('test_scope', 'idle')]
+        rate_limits._prune_buckets(bucket.ts + 10)
+        assert ('test_scope', 'idle') not in rate_limits._BUCKETS
+        assert ('test_scope', 'busy') in rate_limits._BUCKETS
+
+
+class TestJwtCache:
+    """Tests for cached JWT signature verification"""
+    
+    @pytest.fixture
+    def client(self, app_module):
+        app_module.jwt_cache._entries.clear()
+        return app_module.app.test_client()
+    
+    def token(self, app_module, **kwargs):
+        with app_module.app.app_context():
+            return app_module.create_access_token(identity="424242", **kwargs)
+    
+    def get_keys(self, client, token):
+        return client.get('/api/keys', headers={'Authorization': f'Bearer {token}'})
+    
+    def test_overridden_method_signature(self, app_module):
+        """Test the private flask_jwt_extended method the cache overrides still exists unchanged"""
+        import inspect
+        decode = getattr(app_module.JWTManager, '_decode_jwt_from_config', None)
+        
+        assert decode is not None
+        assert list(inspect.signature(decode).parameters) == [
+            'self', 'encoded_token', 'csrf_value', 'allow_expired'
+        ]
+    
+    def test_cache_miss_then_hit(self, app_module, client):
+        """Test the first request verifies the signature and later ones reuse the cached claims"""
+        token = self.token(app_module)
+        decode = app_module.JWTManager._decode_jwt_from_config
+        
+        with patch.object(app_module.JWTManager, '_decode_jwt_from_config', autospec=True,
+                          side_effect=decode) as verify:
+            assert self.get_keys(client, token).status_code == 200
+            assert self.get_keys(client, token).status_code == 200
+            assert verify.call_count == 1
+        
+        assert app_module.jwt_cache.get(token)['sub'] == "424242"
+    
+    def test_expired_token_rejected(self, app_module, client):
+        """Test a cached token stops working once it expires"""
+        import time
+        token = self.token(app_module, expires_delta=timedelta(seconds=1))
+        assert self.get_keys(client, token).status_code == 200
+        
+        time.sleep(1.1)
+        assert self.get_keys(client, token).status_code == 401
+        assert app_module.jwt_cache.get(token) is None
+    
+    def test_revoked_token_rejected_on_cache_hit(self, app_module, client):
+        """Test the blocklist callback still runs for tokens served from the cache"""
+        token = self.token(app_module)
+        assert self.get_keys(client, token).status_code == 200
+        assert app_module.jwt_cache.get(token) is not None
+        
+        revoked = set()
+        manager = app_module.jwt
+        with patch.object(manager, '_token_in_blocklist_callback',
+                          lambda header, payload: payload['jti'] in revoked):
+            assert self.get_keys(client, token).status_code == 200
+            revoked.add(app_module.jwt_cache.get(token)['jti'])
+            assert self.get_keys(client, token).status_code == 401
+
+
+def test_2fa_setup_without_qr(app_module):
+    """Test ?qr=false returns the otpauth URI with matching instructions"""
+    client = app_module.app.test_client()
+    with app_module.app.app_context():
+        token = app_module.create_access_token(identity="1")
+    uri = "otpauth://totp/NovaSuite-AI:qr%40example.com?secret=JBSWY3DPEHPK3PXP&issuer=NovaSuite-AI"
+    
+    with patch.object(app_module.two_factor_auth, 'enable_2fa_totp',
+                      return_value=("JBSWY3DPEHPK3PXP", uri, ["CODE0001"])) as enable:
+        response = client.post('/api/auth/2fa/setup?qr=false', headers={'Authorization': f'Bearer {token}'})
+    
+    assert response.status_code == 200
+    assert enable.call_args.kwargs['qr'] is False
+    assert 'qr_code' not in response.json
+    assert response.json['otpauth_uri'] == uri
+    assert 'Scan QR code' not in response.json['message']
@@ -3,19 +3,50 @@ Tests básicos para el sistema de autenticación NovaSuite-AI
 """
 
 import pytest
+import io
 import json
 from datetime import datetime, timedelta
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 import sys
 import os
 
 # Add src to path for imports
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from core.auth import TwoFactorAuth, APIKeyManager, AuditLogger, GDPRCompliance
+from core.auth import TwoFactorAuth, UserAuthCache, APIKeyManager, AuditLogger, GDPRCompliance
 from core.auth.models import User, APIKey, AuditLog, GDPRRecord, Base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects import postgresql
+
+
+class DictRedis(dict):
+    """In-memory stand-in for the redis client calls used by TwoFactorAuth (no expiry)"""
+    
+    def setex(self, key, ttl, value):
+        self[key] = value
+    
+    def delete(self, *keys):
+        return sum(self.pop(key, None) is not None for key in keys)
+    
+    def incr(self, key):
+        self[key] = self.get(key, 0) + 1
+        return self[key]
+    
+    def expire(self, key, ttl):
+        return key in self
+    
+    def pipeline(self):
+        client = self
+        
+        class Pipeline(list):
+            def __getattr__(self, name):
+                return lambda *args: self.append((getattr(client, name), args))
+            
+            def execute(self):
+                return [method(*args) for method, args in self]
+        
+        return Pipeline()
 
 
 class TestAuthenticationSystem:
@@ -90,6 +121,10 @@ class TestAuthenticationSystem:
         assert user.two_factor_secret is not None
         assert not user.two_factor_enabled  # Not enabled until verified
         
+        # Clients that render the QR code themselves get the provisioning URI
+        _, otpauth_uri, _ = two_factor_auth.enable_2fa_totp(user.id, qr=False)
+        assert otpauth_uri == user.get_2fa_uri()
+        
         # Verify and enable 2FA (mock TOTP verification)
         with patch.object(user, 'verify_2fa_token', return_value=True):
             result = two_factor_auth.verify_and_enable_2fa(user.id, "123456")
@@ -98,6 +133,162 @@ class TestAuthenticationSystem:
         db_session.refresh(user)
         assert user.two_factor_enabled
     
+    def test_verify_totp_window(self):
+        """Test the accepted clock drift grows with valid_window beyond three steps"""
+        import pyotp
+        from core.auth.models import verify_totp
+        secret = pyotp.random_base32()
+        drifted = pyotp.TOTP(secret).at(datetime.now(), -4)
+        
+        assert not verify_totp(secret, drifted, valid_window=3)
+        assert verify_totp(secret, drifted, valid_window=4)
+        assert verify_totp(secret, pyotp.TOTP(secret).now(), valid_window=0)
+    
+    def test_2fa_state_cache(self, db_session, audit_logger, email_config, user):
+        """Test 2FA login checks use cached state and writes invalidate it"""
+        import pyotp
+        from cryptography.fernet import Fernet
+        client = DictRedis()
+        cipher = Fernet(Fernet.generate_key())
+        two_factor_auth = TwoFactorAuth(db_session, email_config, audit_logger,
+                                        auth_cache=UserAuthCache(client, cipher=cipher))
+        secret, _, backup_codes = two_factor_auth.enable_2fa_totp(user.id)
+        user.two_factor_enabled = True
+        db_session.commit()
+        
+        # Backup codes are spent against the database row, once
+        assert two_factor_auth.verify_2fa_login(user.id, backup_codes[0], "backup")
+        assert not two_factor_auth.verify_2fa_login(user.id, backup_codes[0], "backup")
+        
+        assert two_factor_auth.get_2fa_status(user.id)["enabled"] is True
+        cached = client[f"2fa:user:{user.id}"]
+        assert secret.encode() not in cached
+        
+        # Served from the cache: the database row no longer matters until invalidation
+        db_session.expunge(user)
+        with patch.object(db_session, "get", side_effect=AssertionError("cache miss")):
+            assert two_factor_auth.verify_2fa_login(user.id, pyotp.TOTP(secret).now())
+        
+        user = db_session.get(User, user.id)
+        assert two_factor_auth.disable_2fa(user.id, pyotp.TOTP(secret).now())
+        assert f"2fa:user:{user.id}" not in client
+        assert two_factor_auth.get_2fa_status(user.id)["enabled"] is False
+        
+        # Without the User in the session, state comes from a column-only query
+        user_id = user.id
+        db_session.expunge_all()
+        uncached = TwoFactorAuth(db_session, email_config, audit_logger)
+        assert uncached.get_2fa_status(user_id)["enabled"] is False
+        assert not any(isinstance(obj, User) for obj in db_session.identity_map.values())
+    
+    def test_backup_code_spent_once_across_sessions(self, tmp_path, email_config):
+        """Test two sessions racing to spend the same backup code: exactly one succeeds"""
+        engine = create_engine(f"sqlite:///{tmp_path / 'backup.db'}")
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+        first, second = Session(), Session()
+        owner = User(username="owner", email="owner@example.com", two_factor_enabled=True)
+        codes = owner.generate_backup_codes()
+        first.add(owner)
+        first.commit()
+        owner_id = owner.id
+        
+        audit_logger = AuditLogger(first, log_directory=str(tmp_path / "logs"))
+        first_auth = TwoFactorAuth(first, email_config, audit_logger)
+        second_auth = TwoFactorAuth(second, email_config, audit_logger)
+        results = []
+        raced = []
+        execute = first.execute
+        
+        def interleaved(statement, *args, **kwargs):
+            if not raced and getattr(statement, "is_update", False):
+                # The other login spends the code between this read and the swap
+                raced.append(True)
+                results.append(second_auth.verify_2fa_login(owner_id, codes[0], "backup"))
+            return execute(statement, *args, **kwargs)
+        
+        try:
+            with patch.object(first, "execute", side_effect=interleaved):
+                results.append(first_auth.verify_2fa_login(owner_id, codes[0], "backup"))
+            assert results == [True, False]
+            
+            with engine.connect() as conn:
+                remaining, version = conn.execute(
+                    text("SELECT backup_codes, backup_codes_version FROM users WHERE id = :id"),
+                    {"id": owner_id}
+                ).one()
+            assert len(json.loads(remaining)) == 9
+            assert version == 2
+            assert first_auth.verify_2fa_login(owner_id, codes[1], "backup")
+        finally:
+            first.close()
+            second.close()
+    
+    def test_verification_email_reuses_smtp_connection(self, db_session, audit_logger, email_config):
+        """Test verification emails share one SMTP session per thread and reconnect once it drops"""
+        import smtplib
+        two_factor_auth = TwoFactorAuth(db_session, email_config, audit_logger)
+        
+        with patch("core.auth.two_factor_auth.smtplib.SMTP") as smtp:
+            smtp.return_value.send_message.side_effect = [None, None, smtplib.SMTPServerDisconnected(), None]
+            try:
+                two_factor_auth._send_verification_email("a@example.com", "123456")
+                two_factor_auth._send_verification_email("b@example.com", "654321")
+                assert smtp.call_count == 1
+                assert smtp.return_value.login.call_count == 1
+                
+                two_factor_auth._send_verification_email("c@example.com", "111111")
+                assert smtp.call_count == 2
+                assert smtp.return_value.send_message.call_count == 4
+            finally:
+                two_factor_auth._close_smtp_connection()
+    
+    def test_email_tokens_in_redis(self, db_session, audit_logger, email_config, user):
+        """Test email 2FA codes stored in Redis are single-use and limited to three attempts"""
+        client = DictRedis()
+        two_factor_auth = TwoFactorAuth(db_session, email_config, audit_logger, redis_client=client)
+        
+        with patch("core.auth.two_factor_auth.email_executor"):
+            token_id = two_factor_auth.send_email_verification_code(user.id)
+            other_id = two_factor_auth.send_email_verification_code(user.id)
+        code = json.loads(client[f"e2fa:{token_id}"])["code"]
+        other_code = json.loads(client[f"e2fa:{other_id}"])["code"]
+        assert not two_factor_auth.email_tokens
+        
+        assert two_factor_auth.verify_email_code(token_id, code)
+        assert not two_factor_auth.verify_email_code(token_id, code)
+        
+        for _ in range(3):
+            assert not two_factor_auth.verify_email_code(other_id, "wrong")
+        assert not two_factor_auth.verify_email_code(other_id, other_code)
+        assert f"e2fa:{other_id}" not in client
+    
+    def test_backup_code_consumption(self, db_session, user):
+        """Test backup codes are single-use and persisted after consumption"""
+        codes = user.generate_backup_codes()
+        db_session.commit()
+        
+        assert user.verify_backup_code(codes[0])
+        db_session.commit()
+        db_session.refresh(user)
+        
+        assert codes[0] not in user.backup_codes
+        assert not user.verify_backup_code(codes[0])
+        assert not user.verify_backup_code("invalid")
+        assert len(user.backup_codes) == 9
+        assert all(len(code) == 8 for code in codes)
+        assert not set(codes) & set(user.backup_codes)
+        
+        # Typed codes are accepted in lowercase and with separators
+        typed = f" {codes[1][:4].lower()}-{codes[1][4:].lower()} "
+        assert user.verify_backup_code(typed)
+        assert len(user.backup_codes) == 8
+        
+        # Codes stored in plaintext before hashing still verify once
+        user.backup_codes = ["a1b2c3d4"]
+        assert user.verify_backup_code("A1B2C3D4")
+        assert user.backup_codes == []
+    
     def test_api_key_management(self, db_session, audit_logger, user):
         """Test API key creation, rotation, and verification"""
         api_key_manager = APIKeyManager(db_session, audit_logger)
@@ -114,6 +305,7 @@ class TestAuthenticationSystem:
         assert api_key.name == "Test API Key"
         assert api_key.scopes == ["read", "write"]
         assert api_key.is_valid()
+        assert api_key.key_lookup_hmac == api_key_manager._lookup_hmac(api_key_string)
         
         # Verify API key
         verified_key = api_key_manager.verify_api_key(api_key_string)
@@ -137,6 +329,220 @@ class TestAuthenticationSystem:
         # New key should work
         new_verified = api_key_manager.verify_api_key(new_key_string)
         assert new_verified is not None
+        
+        # Cached verification must not outlive revocation
+        assert api_key_manager.verify_api_key(new_key_string) is not None
+        api_key_manager.revoke_api_key(api_key.id)
+        assert api_key_manager.verify_api_key(new_key_string) is None
+    
+    def test_api_key_model_digest(self, user):
+        """Test APIKey model keys are stored as SHA-256 digests and verified in constant time"""
+        api_key = APIKey(user_id=user.id, name="Model key")
+        key = api_key.generate_key()
+        
+        assert key not in api_key.key_hash
+        assert len(api_key.key_hash) == 64
+        assert api_key.verify_key(key)
+        assert not api_key.verify_key(key + "x")
+        assert not api_key.verify_key("")
+    
+    def test_lookup_indexes_created(self, db_session):
+        """Test the per-user and retention lookup indexes exist in the schema"""
+        inspector = inspect(db_session.get_bind())
+        
+        def index_names(table):
+            return {index['name'] for index in inspector.get_indexes(table)}
+        
+        assert 'ix_gdpr_records_user_date' in index_names('gdpr_records')
+        assert {'ix_audit_logs_user_timestamp', 'ix_audit_logs_retention_until'} <= index_names('audit_logs')
+        assert 'ix_api_keys_user_active' in index_names('api_keys')
+        assert any(constraint['column_names'] == ['key_hash']
+                   for constraint in inspector.get_unique_constraints('api_keys'))
+        
+        # Array columns are JSONB on PostgreSQL
+        pg_type = User.__table__.c.backup_codes.type.dialect_impl(postgresql.dialect())
+        assert isinstance(pg_type, postgresql.JSONB)
+    
+    def test_api_key_ip_whitelist(self, db_session, audit_logger, user):
+        """Test API key IP whitelists accept single addresses and CIDR ranges"""
+        api_key_manager = APIKeyManager(db_session, audit_logger)
+        api_key_string, _ = api_key_manager.create_api_key(
+            user_id=user.id, name="Office", ip_whitelist=["10.0.0.0/8", "192.168.1.5"]
+        )
+        
+        assert api_key_manager.verify_api_key(api_key_string, client_ip="10.20.30.40") is not None
+        assert api_key_manager.verify_api_key(api_key_string, client_ip="192.168.1.5") is not None
+        assert api_key_manager.verify_api_key(api_key_string, client_ip="192.168.1.6") is None
+        assert api_key_manager.verify_api_key(api_key_string, client_ip="not-an-ip") is None
+        
+        with pytest.raises(ValueError):
+            api_key_manager.create_api_key(user_id=user.id, name="Bad", ip_whitelist=["10.0.0.0/33"])
+    
+    def test_api_key_subkeys_are_independent(self, db_session, audit_logger):
+        """Test each use of the encryption key gets its own HKDF subkey"""
+        import base64
+        api_key_manager = APIKeyManager(db_session, audit_logger)
+        same_key_manager = APIKeyManager(db_session, audit_logger, encryption_key=api_key_manager.encryption_key)
+        
+        subkeys = {
+            api_key_manager.hmac_key,
+            api_key_manager.derive_key("api-key-aes-gcm"),
+            api_key_manager.derive_key("2fa-state-cache")
+        }
+        assert len(subkeys) == 3
+        assert base64.urlsafe_b64decode(api_key_manager.encryption_key) not in subkeys
+        assert same_key_manager.derive_key("2fa-state-cache") == api_key_manager.derive_key("2fa-state-cache")
+        
+        api_key_manager.close()
+        same_key_manager.close()
+    
+    def test_backfill_lookup_hmacs(self, db_session, audit_logger, user):
+        """Test keys without a lookup HMAC become verifiable after backfill"""
+        api_key_manager = APIKeyManager(db_session, audit_logger)
+        api_key_string, api_key = api_key_manager.create_api_key(user_id=user.id, name="Legacy")
+        assert api_key.key_hash.startswith("gcm1:")
+        # Keys from before the lookup index were stored as Fernet tokens
+        api_key.key_hash = api_key_manager.cipher_suite.encrypt(api_key_string.encode()).decode()
+        api_key.key_lookup_hmac = None
+        _, malformed = api_key_manager.create_api_key(user_id=user.id, name="Malformed")
+        malformed.key_hash = "not-a-ciphertext"
+        malformed.key_lookup_hmac = None
+        db_session.commit()
+        
+        assert api_key_manager.verify_api_key(api_key_string) is None
+        assert api_key_manager.backfill_lookup_hmacs() == 1
+        assert api_key_manager.verify_api_key(api_key_string) is not None
+        assert api_key_manager.backfill_lookup_hmacs() == 0
+    
+    def test_verify_api_key_cache_hit_skips_select(self, db_session, audit_logger, user):
+        """Test a cached verification neither reads nor writes the key row"""
+        api_key_manager = APIKeyManager(db_session, audit_logger)
+        api_key_string, api_key = api_key_manager.create_api_key(user_id=user.id, name="Cached", scopes=["read"])
+        engine = db_session.get_bind()
+        
+        assert api_key_manager.verify_api_key(api_key_string, ["read"]) is not None
+        
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            assert api_key_manager.verify_api_key(api_key_string, ["read"]) is not None
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        
+        assert not [s for s in statements if "api_keys" in s]
+        
+        api_key_manager.flush_usage()
+        db_session.refresh(api_key)
+        assert api_key.usage_count == 2
+        assert api_key.last_used is not None
+    
+    def test_failed_usage_flush_is_retried(self, db_session, audit_logger, user):
+        """Test usage from a failed flush is merged into the next one instead of lost"""
+        api_key_manager = APIKeyManager(db_session, audit_logger, usage_flush_interval=3600)
+        api_key_string, api_key = api_key_manager.create_api_key(user_id=user.id, name="Retried")
+        
+        assert api_key_manager.verify_api_key(api_key_string) is not None
+        with patch.object(api_key_manager, "_get_usage_engine", side_effect=RuntimeError("database unavailable")):
+            api_key_manager.flush_usage()
+        assert api_key_manager.verify_api_key(api_key_string) is not None
+        last_used = api_key_manager._usage_counters[api_key.id][1]
+        
+        api_key_manager.flush_usage()
+        db_session.refresh(api_key)
+        assert api_key.usage_count == 2
+        assert api_key.last_used == last_used
+        api_key_manager.close()
+    
+    def test_api_key_usage_flushed_in_background(self, tmp_path):
+        """Test a manager built without an engine still persists usage from its flusher thread"""
+        import time
+        engine = create_engine(f"sqlite:///{tmp_path / 'keys.db'}")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        owner = User(username="owner", email="owner@example.com")
+        session.add(owner)
+        session.commit()
+        
+        api_key_manager = APIKeyManager(session, AuditLogger(session, log_directory=str(tmp_path / "logs")),
+                                        usage_flush_interval=0.05)
+        try:
+            api_key_string, api_key = api_key_manager.create_api_key(user_id=owner.id, name="Flushed")
+            assert api_key_manager.verify_api_key(api_key_string) is not None
+            
+            deadline = time.monotonic() + 5
+            usage_count = 0
+            while usage_count != 1 and time.monotonic() < deadline:
+                time.sleep(0.05)
+                with engine.connect() as conn:
+                    usage_count = conn.execute(
+                        text("SELECT usage_count FROM api_keys WHERE id = :id"), {"id": api_key.id}
+                    ).scalar()
+            assert usage_count == 1
+        finally:
+            api_key_manager.close()
+            session.close()
+    
+    def test_list_api_keys_query_count(self, db_session, audit_logger, user):
+        """Test listing API keys issues a constant number of queries"""
+        api_key_manager = APIKeyManager(db_session, audit_logger)
+        engine = db_session.get_bind()
+        
+        def count_list_queries():
+            statements = []
+            listener = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(engine, "before_cursor_execute", listener)
+            try:
+                api_key_manager.list_user_api_keys(user.id)
+            finally:
+                event.remove(engine, "before_cursor_execute", listener)
+            return len(statements)
+        
+        api_key_manager.create_api_key(user_id=user.id, name="Key 1")
+        single_key_queries = count_list_queries()
+        
+        for i in range(5):
+            api_key_manager.create_api_key(user_id=user.id, name=f"Key {i + 2}")
+        
+        assert count_list_queries() == single_key_queries
+        assert len(api_key_manager.list_user_api_keys(user.id)) == 6
+    
+    def test_api_key_stats(self, db_session, audit_logger, user):
+        """Test API key statistics aggregates"""
+        api_key_manager = APIKeyManager(db_session, audit_logger)
+        
+        api_key_manager.create_api_key(user_id=user.id, name="Reader", scopes=["read"])
+        api_key_manager.create_api_key(user_id=user.id, name="Writer", scopes=["read", "write"], expires_days=3)
+        _, revoked = api_key_manager.create_api_key(user_id=user.id, name="Old", expires_days=-1)
+        api_key_manager.revoke_api_key(revoked.id)
+        
+        stats = api_key_manager.get_api_key_stats(user.id)
+        
+        assert stats['total_keys'] == 3
+        assert stats['active_keys'] == 2
+        assert stats['expired_keys'] == 1
+        assert stats['expiring_soon'] == 2
+        assert stats['total_usage'] == 0
+        assert stats['keys_by_scope'] == {'read': 2, 'write': 1}
+        assert api_key_manager.get_api_key_stats(user.id + 1)['total_keys'] == 0
+    
+    def test_rotate_expiring_keys_in_batches(self, db_session, audit_logger, user):
+        """Test expiring keys are rotated across several batches"""
+        api_key_manager = APIKeyManager(db_session, audit_logger)
+        api_key_manager.rotation_batch_size = 2
+        
+        old_keys = [
+            api_key_manager.create_api_key(user_id=user.id, name=f"Expiring {i}", expires_days=3)[0]
+            for i in range(5)
+        ]
+        api_key_manager.create_api_key(user_id=user.id, name="Fresh", expires_days=30)
+        
+        rotated = api_key_manager.rotate_expiring_keys(days_before_expiry=7)
+        
+        assert len(rotated) == 5
+        assert all(api_key_manager.verify_api_key(key) is None for key in old_keys)
+        assert all(api_key_manager.verify_api_key(info['new_key']) is not None for info in rotated)
+        assert api_key_manager.rotate_expiring_keys(days_before_expiry=7) == []
     
     def test_audit_logging(self, db_session, audit_logger, user):
         """Test audit logging functionality"""
@@ -154,7 +560,8 @@ class TestAuthenticationSystem:
         # Search for the logged event
         results = audit_logger.search_audit_logs(
             filters={"user_id": user.id, "event_category": "test"},
-            limit=10
+            limit=10,
+            include_total=True
         )
         
         assert results["total_count"] == 1
@@ -168,6 +575,225 @@ class TestAuthenticationSystem:
         assert log_entry["ip_address"] == "192.168.1.100"
         assert log_entry["metadata"]["test_data"] == "test_value"
     
+    def test_search_audit_logs_keyset_pagination(self, audit_logger):
+        """Test search pages via limit+1 and (timestamp, id) cursors without counting"""
+        for i in range(5):
+            audit_logger.log_event(event_type="paged_event", event_category="test", action=f"action_{i}")
+        
+        seen = []
+        cursor = {}
+        while True:
+            # A stale offset sent along with the cursor must not skip rows
+            page = audit_logger.search_audit_logs(filters={"event_type": "paged_event"}, limit=2,
+                                                  offset=2 if cursor else 0, **cursor)
+            assert page["total_count"] is None
+            seen.extend(log["action"] for log in page["logs"])
+            if not page["has_more"]:
+                break
+            cursor = {
+                "after_timestamp": datetime.fromisoformat(page["next_cursor"]["after_timestamp"]),
+                "after_id": page["next_cursor"]["after_id"]
+            }
+        
+        assert sorted(seen) == [f"action_{i}" for i in range(5)]
+        assert len(seen) == 5
+    
+    def test_batched_audit_writes(self, tmp_path):
+        """Test batched audit logging inserts queued events"""
+        engine = create_engine(f"sqlite:///{tmp_path / 'audit.db'}")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        
+        batch_logger = AuditLogger(
+            session, log_directory=str(tmp_path / "logs"), batch_writes=True, engine=engine,
+            writer_shards=2
+        )
+        try:
+            for i in range(300):
+                batch_logger.log_event(
+                    event_type="batched_event",
+                    event_category="test",
+                    action="test_action",
+                    metadata={"index": i}
+                )
+            
+            for i in range(3):
+                batch_logger.log_event_async(
+                    event_type="async_event",
+                    event_category="api",
+                    action="verify_api_key",
+                    user_id=i + 1,
+                    api_key_id=i + 1
+                )
+            
+            results = batch_logger.search_audit_logs(
+                filters={"event_type": "batched_event"}, limit=1, include_total=True
+            )
+            assert results["total_count"] == 300
+            assert results["logs"][0]["retention_until"] is not None
+            assert batch_logger.search_audit_logs(
+                filters={"event_type": "async_event"}, include_total=True
+            )["total_count"] == 3
+            # SQLite has a single writer, so shards collapse to one
+            assert len(batch_logger._writer_threads) == 1
+            
+            # Critical events bypass the queue and are committed before log_event returns
+            batch_logger.log_event(event_type="2fa_disabled", event_category="security",
+                                   action="disable_2fa", user_id=1, critical=True)
+            with engine.connect() as conn:
+                assert conn.exec_driver_sql(
+                    "SELECT COUNT(*) FROM audit_logs WHERE event_type = '2fa_disabled'"
+                ).scalar() == 1
+        finally:
+            batch_logger.close()
+            session.close()
+    
+    def test_audit_queue_shards_by_user(self, db_session, tmp_path):
+        """Test queued audit rows are routed to writer shards by user_id"""
+        shard_logger = AuditLogger(db_session, log_directory=str(tmp_path / "logs"), writer_shards=2)
+        
+        for user_id in (None, 1, 2, 3, 4):
+            shard_logger._enqueue(shard_logger._build_row(
+                "event", "api", "action", user_id, True, None,
+                None, None, None, None, None, None
+            ))
+        
+        assert [row["user_id"] for row in shard_logger._shards[0]] == [None, 2, 4]
+        assert [row["user_id"] for row in shard_logger._shards[1]] == [1, 3]
+        shard_logger.flush()
+        assert db_session.query(AuditLog).count() == 5
+    
+    def test_audit_queue_backpressure(self, db_session, tmp_path):
+        """Test the audit queue sheds low-priority rows and writes must-keep rows when full"""
+        log_dir = tmp_path / "logs"
+        queue_logger = AuditLogger(db_session, log_directory=str(log_dir), max_pending=5)
+        
+        def row(category, success):
+            return queue_logger._build_row(
+                "event", category, "action", None, success, None,
+                None, None, None, None, None, None
+            )
+        
+        for _ in range(6):
+            queue_logger._enqueue(row("api", True))
+        assert len(queue_logger._shards[0]) == 4
+        assert queue_logger.dropped_events == 2
+        
+        # GDPR events and security failures are still queued above the threshold,
+        # then written synchronously once the queue is full
+        queue_logger._enqueue(row("gdpr", True))
+        queue_logger._enqueue(row("security", False))
+        assert len(queue_logger._shards[0]) == 5
+        assert queue_logger.spilled_events == 1
+        assert db_session.query(AuditLog).filter(AuditLog.event_category == "security").count() == 1
+        
+        queue_logger.close()
+        summary = db_session.query(AuditLog).filter_by(event_type="audit_events_dropped").one()
+        assert summary.metadata["dropped"] == 2
+        assert db_session.query(AuditLog).filter(AuditLog.event_type == "event").count() == 6
+    
+    def test_durable_audit_writes_skip_async_commit(self, db_session, tmp_path):
+        """Test critical and must-keep audit rows are not committed asynchronously on PostgreSQL"""
+        from core.auth.audit_logger import _ASYNC_COMMIT_STMT
+        engine = MagicMock()
+        conn = engine.begin.return_value.__enter__.return_value
+        conn.dialect.name = "postgresql"
+        pg_logger = AuditLogger(db_session, log_directory=str(tmp_path / "logs"),
+                                batch_writes=True, engine=engine)
+        
+        def async_commits():
+            return [c for c in conn.execute.call_args_list if c.args[0] is _ASYNC_COMMIT_STMT]
+        
+        def row(category):
+            return pg_logger._build_row(
+                "event", category, "action", None, True, None,
+                None, None, None, None, None, None
+            )
+        
+        try:
+            pg_logger.log_event(event_type="2fa_disabled", event_category="security",
+                                action="disable_2fa", user_id=1, critical=True)
+            pg_logger._write_items([row("api"), row("gdpr")])
+            assert conn.execute.call_count == 2
+            assert not async_commits()
+            
+            pg_logger._write_items([row("api")])
+            assert len(async_commits()) == 1
+        finally:
+            pg_logger.close()
+    
+    def test_cleanup_expired_logs_in_batches(self, db_session, audit_logger):
+        """Test expired audit logs are deleted in chunks and recent ones are kept"""
+        for i in range(5):
+            audit_logger.log_event(event_type="old_event", event_category="auth", action=f"old_{i}")
+        audit_logger.log_event(event_type="recent_event", event_category="auth", action="recent")
+        
+        db_session.query(AuditLog).filter_by(event_type="old_event").update(
+            {AuditLog.retention_until: datetime.utcnow() - timedelta(days=1)}
+        )
+        db_session.commit()
+        
+        assert audit_logger.cleanup_expired_logs(batch_size=2) == 5
+        assert db_session.query(AuditLog).filter_by(event_type="old_event").count() == 0
+        assert db_session.query(AuditLog).filter_by(event_type="recent_event").count() == 1
+        assert db_session.query(AuditLog).filter_by(event_type="audit_logs_cleaned").one().metadata == {
+            'deleted_logs_count': 5
+        }
+        
+        # Nothing else is due until the earliest remaining retention deadline
+        assert audit_logger._next_retention_expiry > datetime.utcnow()
+        with patch.object(audit_logger, 'flush') as flush:
+            assert audit_logger.cleanup_expired_logs() == 0
+        flush.assert_not_called()
+    
+    def test_export_user_audit_data_streaming(self, audit_logger, user):
+        """Test streamed audit exports match the in-memory export"""
+        for i in range(3):
+            audit_logger.log_event(event_type="login", event_category="auth", action=f"login_{i}",
+                                   user_id=user.id, metadata={"attempt": i})
+        
+        output = io.BytesIO()
+        summary = audit_logger.export_user_audit_data(user.id, output=output)
+        streamed = json.loads(output.getvalue())
+        
+        assert summary["total_events"] == streamed["total_events"] == 3
+        assert "events" not in summary
+        
+        # The streamed export itself was audited for the user
+        exported = audit_logger.export_user_audit_data(user.id)
+        assert exported["total_events"] == 4
+        assert exported["events"][:3] == streamed["events"]
+        assert [event["metadata"]["attempt"] for event in streamed["events"]] == [0, 1, 2]
+        
+        # A limit keeps only the most recent events, oldest first
+        recent = audit_logger.export_user_audit_data(user.id, limit=3)
+        assert [event["action"] for event in recent["events"]] == [
+            "login_2", "export_user_audit_data", "export_user_audit_data"
+        ]
+    
+    def test_event_wrappers_do_not_mutate_additional_data(self, db_session, audit_logger):
+        """Test the log_*_event wrappers copy the caller's additional_data"""
+        additional_data = {"source": "scanner"}
+        audit_logger.log_security_event("port_scan", "Port scan detected", severity="high",
+                                        additional_data=additional_data)
+        audit_logger.log_compliance_event("GDPR", "review", "compliant", "Annual review",
+                                          additional_data=additional_data)
+        
+        assert additional_data == {"source": "scanner"}
+        log = db_session.query(AuditLog).filter_by(event_type="port_scan").one()
+        assert log.metadata == {"source": "scanner", "severity": "high", "description": "Port scan detected"}
+    
+    def test_api_access_sampling(self, db_session, tmp_path):
+        """Test successful API access events are sampled while errors always log"""
+        sampled_logger = AuditLogger(db_session, log_directory=str(tmp_path / "logs"), api_sample_rate=0.0)
+        for _ in range(3):
+            sampled_logger.log_api_access(api_key_id=None, endpoint="/api/items", method="GET", response_code=200)
+        sampled_logger.log_api_access(api_key_id=None, endpoint="/api/items", method="GET", response_code=500)
+        
+        assert sampled_logger.sampled_out_api_events == 3
+        logs = db_session.query(AuditLog).filter_by(event_type="api_request").all()
+        assert [(log.action, log.success) for log in logs] == [("GET_/api/items", False)]
+    
     def test_gdpr_consent_management(self, db_session, audit_logger, email_config, user):
         """Test GDPR consent management"""
         data_controller = {
@@ -205,7 +831,149 @@ class TestAuthenticationSystem:
         assert gdpr_record.request_type == "access"
         assert gdpr_record.access_provided is True
         assert "categories" in user_data
-        assert "personal_identifiers" in user_data["categories"]
+        assert list(user_data["categories"]) == ["personal_identifiers"]
+        
+        # Response payload is stored compressed and decompressed on access
+        db_session.expire(gdpr_record)
+        assert isinstance(gdpr_record.response_data_compressed, bytes)
+        assert gdpr_record.response_data["categories"].keys() == user_data["categories"].keys()
+    
+    def test_gdpr_dashboard(self, db_session, audit_logger, email_config, user):
+        """Test GDPR dashboard aggregates"""
+        gdpr_compliance = GDPRCompliance(db_session, audit_logger, email_config, {'name': 'Test Company'})
+        
+        empty = gdpr_compliance.get_gdpr_dashboard()
+        assert empty["overview"]["total_gdpr_requests"] == 0
+        assert empty["recent_legal_changes"] == []
+        
+        gdpr_compliance.record_consent(user.id, "explicit_consent", True, "web_form")
+        gdpr_compliance.process_access_request(user.id, requested_categories=["personal_identifiers"])
+        gdpr_compliance.process_erasure_request(user.id, reason="User request")
+        gdpr_compliance.log_legal_change("privacy_policy", "Policy update", "Clarified retention periods")
+        
+        dashboard = gdpr_compliance.get_gdpr_dashboard(user.id)
+        
+        assert dashboard["overview"]["total_gdpr_requests"] == 3
+        assert dashboard["overview"]["pending_requests"] == 0
+        assert dashboard["overview"]["scheduled_deletions"] == 1
+        assert dashboard["requests_by_type"] == {
+            "consent": 1, "access": 1, "rectification": 0, "erasure": 1, "portability": 0
+        }
+        assert len(dashboard["user_requests"]) == 3
+        assert [change["title"] for change in dashboard["recent_legal_changes"]] == ["Policy update"]
+        # Request types and statuses are stored as small integers
+        assert db_session.execute(
+            text("SELECT DISTINCT typeof(request_type) || typeof(status) FROM gdpr_records")
+        ).scalars().all() == ["integerinteger"]
+    
+    def test_legal_change_versioning(self, db_session, audit_logger, email_config):
+        """Test legal change versions increment per change type"""
+        gdpr_compliance = GDPRCompliance(db_session, audit_logger, email_config, {'name': 'Test Company'})
+        
+        first = gdpr_compliance.log_legal_change("privacy_policy", "Initial", "First version")
+        second = gdpr_compliance.log_legal_change("privacy_policy", "Update", "Second version")
+        other = gdpr_compliance.log_legal_change("terms_of_service", "Terms", "Separate type")
+        
+        assert first.version == "1.0"
+        assert second.version == "1.1"
+        assert second.previous_version_id == first.id
+        assert other.version == "1.0"
+    
+    def test_process_scheduled_deletions(self, db_session, audit_logger, email_config, user):
+        """Test scheduled deletions anonymize due users and record completions in bulk"""
+        gdpr_compliance = GDPRCompliance(db_session, audit_logger, email_config, {'name': 'Test Company'})
+        
+        user.gdpr_consent = False
+        user.data_retention_until = datetime.utcnow() - timedelta(days=1)
+        kept = User(username="keptuser", email="kept@example.com")
+        kept.gdpr_consent = False
+        kept.data_retention_until = datetime.utcnow() + timedelta(days=30)
+        db_session.add(kept)
+        db_session.commit()
+        
+        deleted = gdpr_compliance.process_scheduled_deletions()
+        
+        assert [(d["user_id"], d["username"]) for d in deleted] == [(user.id, "testuser")]
+        db_session.refresh(user)
+        assert user.username == f"deleted_user_{user.id}"
+        record = db_session.query(GDPRRecord).filter_by(user_id=user.id, request_type="erasure").one()
+        assert record.status == "completed"
+        assert record.request_date is not None
+        assert db_session.query(GDPRRecord).filter_by(user_id=kept.id).count() == 0
+    
+    def test_erased_users_evicted_from_caches(self, db_session, audit_logger, email_config, user):
+        """Test keys and 2FA state of erased users stop being served from caches right away"""
+        from cryptography.fernet import Fernet
+        client = DictRedis()
+        api_key_manager = APIKeyManager(db_session, audit_logger)
+        two_factor_auth = TwoFactorAuth(db_session, email_config, audit_logger,
+                                        auth_cache=UserAuthCache(client, cipher=Fernet(Fernet.generate_key())))
+        gdpr_compliance = GDPRCompliance(db_session, audit_logger, email_config, {'name': 'Test Company'})
+        gdpr_compliance.on_users_erased(api_key_manager.invalidate_users)
+        gdpr_compliance.on_users_erased(two_factor_auth.invalidate_users)
+        
+        kept = User(username="keptuser", email="kept@example.com")
+        db_session.add(kept)
+        db_session.commit()
+        erased_key, _ = api_key_manager.create_api_key(user_id=user.id, name="Erased")
+        kept_key, _ = api_key_manager.create_api_key(user_id=kept.id, name="Kept")
+        assert api_key_manager.verify_api_key(erased_key) is not None
+        assert api_key_manager.verify_api_key(kept_key) is not None
+        two_factor_auth.get_2fa_status(user.id)
+        assert f"2fa:user:{user.id}" in client
+        
+        user.gdpr_consent = False
+        user.data_retention_until = datetime.utcnow() - timedelta(days=1)
+        db_session.commit()
+        gdpr_compliance.process_scheduled_deletions()
+        
+        assert api_key_manager.verify_api_key(erased_key) is None
+        assert f"2fa:user:{user.id}" not in client
+        with patch.object(db_session, "execute", side_effect=AssertionError("cache miss")):
+            assert api_key_manager.verify_api_key(kept_key) is not None
+        api_key_manager.close()
+    
+    def test_process_scheduled_deletions_failure(self, db_session, audit_logger, email_config, user):
+        """Test a failed deletion run is rolled back, lists the attempted users and logs no completions"""
+        gdpr_compliance = GDPRCompliance(db_session, audit_logger, email_config, {'name': 'Test Company'})
+        user.gdpr_consent = False
+        user.data_retention_until = datetime.utcnow() - timedelta(days=1)
+        db_session.commit()
+        
+        with patch.object(db_session, "commit", side_effect=[RuntimeError("commit failed")] + [None] * 5):
+            with pytest.raises(RuntimeError):
+                gdpr_compliance.process_scheduled_deletions()
+            
+            assert db_session.query(AuditLog).filter_by(event_type="gdpr_data_erasure_completed").count() == 0
+            failure = db_session.query(AuditLog).filter_by(event_type="gdpr_scheduled_deletion").one()
+            assert failure.metadata["attempted_user_ids"] == [user.id]
+            assert user.username == "testuser"
+    
+    def test_save_as_csv_flattens_nested_data(self, db_session, audit_logger, email_config, tmp_path):
+        """Test CSV exports flatten nested dicts and number list entries"""
+        gdpr_compliance = GDPRCompliance(db_session, audit_logger, email_config, {'name': 'Test Company'})
+        csv_path = tmp_path / "export.csv"
+        
+        gdpr_compliance._save_as_csv(
+            {"user": {"id": 1, "roles": ["admin", {"scope": "read"}]}, "format": "csv"}, csv_path
+        )
+        
+        assert csv_path.read_text().splitlines() == [
+            "Field,Value", "user_id,1", "user_roles_0,admin", "user_roles_1_scope,read", "format,csv"
+        ]
+    
+    def test_portability_json_export(self, db_session, audit_logger, email_config, user, tmp_path, monkeypatch):
+        """Test portability requests write an indented JSON export"""
+        monkeypatch.chdir(tmp_path)
+        gdpr_compliance = GDPRCompliance(db_session, audit_logger, email_config, {'name': 'Test Company'})
+        
+        gdpr_record, export_path = gdpr_compliance.process_portability_request(user.id)
+        
+        exported = json.loads((tmp_path / export_path).read_text())
+        assert gdpr_record.status == "completed"
+        assert exported["export_type"] == "data_portability"
+        assert exported["categories"]["personal_identifiers"]["username"] == "testuser"
+        assert (tmp_path / export_path).read_text().startswith('{\n  "')
     
     def test_account_lockout(self, db_session, user):
         """Test account lockout mechanism"""
@@ -241,6 +1009,7 @@ class TestAuthenticationSystem:
         
         original_username = user.username
         original_email = user.email
+        _, api_key = APIKeyManager(db_session, audit_logger).create_api_key(user_id=user.id, name="Erased")
         
         # Request data erasure
         gdpr_record = gdpr_compliance.process_erasure_request(
@@ -259,6 +1028,8 @@ class TestAuthenticationSystem:
         assert user.email != original_email
         assert user.username.startswith("deleted_user_")
         assert user.password_hash is None
+        db_session.refresh(api_key)
+        assert api_key.is_active is False
     
     def test_api_key_expiration(self, db_session, audit_logger, user):
         """Test API key expiration logic"""
@@ -317,6 +1088,34 @@ class TestAuthenticationSystem:
         assert report["events_by_category"]["auth"] == 2
         assert report["events_by_category"]["api"] == 1
         assert report["events_by_category"]["gdpr"] == 1
+        assert report["events_by_user"] == {user.id: 4}
+        assert report["daily_activity"] == {datetime.utcnow().date().isoformat(): 4}
+        
+        # Security incidents: failures and high-severity events only
+        audit_logger.log_event(event_type="login", event_category="auth", action="user_login",
+                               user_id=user.id, success=False)
+        audit_logger.log_event(event_type="suspicious_activity", event_category="security",
+                               action="detect", success=True, metadata={"severity": "high"})
+        audit_logger.log_event(event_type="routine_check", event_category="security",
+                               action="check", success=True, metadata={"severity": "low"})
+        report = audit_logger.generate_compliance_report(start_date=start_date, end_date=end_date)
+        
+        assert report["summary"]["failed_events"] == 1
+        assert report["security_analysis"]["security_events_count"] == 2
+        assert report["security_analysis"]["failed_login_attempts"] == 1
+        assert [i["event_type"] for i in report["security_analysis"]["security_incidents"]] == [
+            "suspicious_activity"
+        ]
+        assert report["security_analysis"]["security_incidents_count"] == 1
+        assert report["security_analysis"]["incidents_truncated"] is False
+        
+        audit_logger.log_event(event_type="intrusion_attempt", event_category="security",
+                               action="detect", success=False)
+        report = audit_logger.generate_compliance_report(start_date=start_date, end_date=end_date,
+                                                         max_incidents=1)
+        assert len(report["security_analysis"]["security_incidents"]) == 1
+        assert report["security_analysis"]["security_incidents_count"] == 2
+        assert report["security_analysis"]["incidents_truncated"] is True
 
 
 def test_system_integration():